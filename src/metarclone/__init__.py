@@ -1,3 +1,26 @@
+import importlib
+import sys
+from types import ModuleType
+
 from .config import UploadConfig, DownloadConfig
-from .upload import upload
-from .download import download
+
+# submodules that export a function of the same name; loaded on first access so `metarclone --help` stays fast
+LAZY_FUNCTIONS = frozenset(('upload', 'download'))
+
+
+class _Package(ModuleType):
+    def __getattr__(self, name: str):
+        if name not in LAZY_FUNCTIONS:
+            raise AttributeError(f'module {self.__name__!r} has no attribute {name!r}')
+        importlib.import_module('.' + name, self.__name__)
+        return self.__dict__[name]
+
+    def __setattr__(self, name: str, value):
+        # importing a submodule binds it to the package attribute of the same name (whoever imports it first);
+        #   keep the function there instead, as the eager `from .upload import upload` did
+        if name in LAZY_FUNCTIONS and isinstance(value, ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+from gzip import GzipFile
+from typing import Dict, Tuple, Optional, List
+
+__all__ = ['ChecksumCache', 'load_checksum_cache', 'save_checksum_cache']
+
+
+class ChecksumCache:
+    """
+    Local cache of whole-file content checksums, keyed by path
+    An entry is only reused if (st_size, st_mtime_ns, st_ctime_ns, st_ino) are unchanged; this trusts the timestamps,
+      so it is only loaded from and saved to disk when the user specifies a cache file, and is otherwise only used
+      within one run
+    Only entries looked up or stored during this run are saved, so deleted files are pruned automatically
+    Entries of files with multiple hard links are also found by (st_dev, st_ino), so the other links of a file hashed
+      earlier in this run are not hashed again
+    """
+    def __init__(self, hash_name: str):
+        self.hash_name = hash_name
+        self.old_entries: Dict[bytes, List] = {}
+        self.entries: Dict[bytes, List] = {}
+        self.inodes: Dict[Tuple[int, int], List] = {}
+
+    @staticmethod
+    def signature(st: os.stat_result) -> Tuple[int, int, int, int]:
+        return st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino
+
+    def get(self, full_path: bytes, st: os.stat_result) -> Optional[bytes]:
+        signature = self.signature(st)
+        entry = self.entries.get(full_path) or self.old_entries.get(full_path)
+        if (entry is None or tuple(entry[:4]) != signature) and st.st_nlink > 1:
+            entry = self.inodes.get((st.st_dev, st.st_ino))
+        if entry is None or tuple(entry[:4]) != signature:
+            return None
+        self.entries[full_path] = entry
+        return bytes.fromhex(entry[4])
+
+    def put(self, full_path: bytes, st: os.stat_result, digest: bytes):
+        # dict assignment is atomic, so this is safe to call from the checksum thread pool
+        entry = self.entries[full_path] = [*self.signature(st), digest.hex()]
+        if st.st_nlink > 1:
+            self.inodes[(st.st_dev, st.st_ino)] = entry
+
+
+def load_checksum_cache(path: str, hash_name: str) -> ChecksumCache:
+    cache = ChecksumCache(hash_name)
+    try:
+        with open(path, 'rb') as stream, GzipFile(mode='rb', fileobj=stream) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return cache
+    except (OSError, ValueError) as e:
+        logging.warning(f'Cannot read checksum cache {path}; ignoring it: {e}')
+        return cache
+    if data.get('hash_function') == hash_name:
+        # paths are stored as str with surrogateescape to allow arbitrary bytes
+        cache.old_entries = {os.fsencode(k): v for k, v in data['files'].items()}
+    return cache
+
+
+def save_checksum_cache(cache: ChecksumCache, path: str):
+    data = {'hash_function': cache.hash_name, 'files': {os.fsdecode(k): v for k, v in cache.entries.items()}}
+    try:
+        with open(path, 'wb') as stream, GzipFile(mode='wb', fileobj=stream) as f:
+            f.write(json.dumps(data).encode())
+    except OSError as e:
+        logging.warning(f'Cannot write checksum cache {path}: {e}')
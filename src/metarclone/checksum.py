@@ -1,13 +1,74 @@
+import operator
 import os
-import stat
+import queue
+import struct
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from io import FileIO
+from stat import S_IFDIR, S_IFLNK, S_IFREG
 from typing import Dict, Tuple, Optional, List
 
 from .config import SyncConfig
-from .utils import wrap_oserror
+from .utils import wrap_oserror, thread_buffer, join_path
+
+BUF_SIZE = 1 << 20
+# Files at least this large are hashed with a reader thread, so that reading and hashing overlap; smaller files do not
+#   take long enough to pay for starting the thread
+PIPELINE_THRESHOLD = 32 << 20
+# Name prefix of the checksum pool threads; they hash several files at once, which already overlaps reading and
+#   hashing, so they do not start reader threads
+CHECKSUM_THREAD_PREFIX = 'checksum'
+# Only hash file contents in the thread pool if a directory has at least this many regular files
+PARALLEL_MIN_FILES = 4
+# Files smaller than SMALL_FILE_SIZE are submitted to the thread pool in batches of SMALL_FILE_BATCH,
+#   since the per-task overhead is comparable to hashing the file itself
+SMALL_FILE_BATCH = 8
+SMALL_FILE_SIZE = 256 * 1024
+# Integers are hashed in little endian; 16-byte ones (st_size, st_mtime_ns) are packed as (low, high) 8-byte halves
+MODE_STRUCT = struct.Struct('<I')
+MTIME_STRUCT = struct.Struct('<Qq')
+OWNER_STRUCT = struct.Struct('<II')
+MTIME_OWNER_STRUCT = struct.Struct('<QqII')
+SIZE_MTIME_STRUCT = struct.Struct('<QQQq')
+SIZE_MTIME_OWNER_STRUCT = struct.Struct('<QQQqII')
+LOW_MASK = (1 << 64) - 1
+# st_mode takes few distinct values in practice, so cache its packed form
+MODE_BYTES: Dict[int, bytes] = {}
+# DirEntry.stat gives different results from os.stat on Windows (st_ino, st_dev and st_nlink are always zero, which
+#   breaks hard link detection), so only use it on POSIX; there it is the same lstat call, cached on the entry
+USE_DIRENTRY_STAT = os.name != 'nt'
+# Advise the kernel to read ahead aggressively on files we hash (Linux and some BSDs only)
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+# Do not update the access time of files we hash (Linux only); only allowed on files owned by the user
+O_NOATIME = getattr(os, 'O_NOATIME', 0)
+# File type bits of st_mode; compared directly instead of calling stat.S_IS* per file
+S_IFMT_MASK = 0o170000
+
+
+# (hash object, remaining children in reverse order)
+DirectoryFrame = Tuple[object, List[Tuple[os.DirEntry, os.stat_result]]]
+# directory path -> its children sorted by name, with their stat results; see checksum_walk
+Listings = Dict[bytes, List[Tuple[os.DirEntry, os.stat_result]]]
+
+
+# Shared by all checksum walks, since checksum_walk is called once per aggregated file during upload
+_pool: Optional[Tuple[int, ThreadPoolExecutor]] = None
+_pool_lock = threading.Lock()
+
+
+def checksum_pool(workers: int) -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0] != workers:
+            if _pool is not None:
+                _pool[1].shutdown(wait=False)
+            _pool = (workers, ThreadPoolExecutor(max_workers=workers, thread_name_prefix=CHECKSUM_THREAD_PREFIX))
+        return _pool[1]
 
 
 class ChecksumWalkResult:
+    __slots__ = ('total_size', 'total_files', 'hard_link_map')
+
     def __init__(self):
         self.total_size = 0
         self.total_files = 0
@@ -15,99 +76,361 @@ class ChecksumWalkResult:
 
 
 def init_file_checksum(name: bytes, st: os.stat_result, conf: SyncConfig):
-    hash_obj = conf.hash_function(conf.head_bytes() + name + st.st_mode.to_bytes(4, 'little'))
-    if stat.S_ISDIR(st.st_mode):
+    mode = st.st_mode
+    # head_bytes() is already absorbed in the prefix
+    hash_obj = conf.hash_prefix().copy()
+    mode_bytes = MODE_BYTES.get(mode)
+    if mode_bytes is None:
+        mode_bytes = MODE_BYTES[mode] = MODE_STRUCT.pack(mode)
+    head = name + mode_bytes
+    if mode & S_IFMT_MASK == S_IFDIR:
+        # Compose all fields first so that the hash function is updated only once
         if conf.use_directory_mtime:
-            hash_obj.update(st.st_mtime_ns.to_bytes(16, 'little', signed=True))
-        if conf.use_owner:
-            hash_obj.update(st.st_uid.to_bytes(4, 'little') + st.st_gid.to_bytes(4, 'little'))
+            mtime = st.st_mtime_ns
+            if conf.use_owner:
+                head += MTIME_OWNER_STRUCT.pack(mtime & LOW_MASK, mtime >> 64, st.st_uid, st.st_gid)
+            else:
+                head += MTIME_STRUCT.pack(mtime & LOW_MASK, mtime >> 64)
+        elif conf.use_owner:
+            head += OWNER_STRUCT.pack(st.st_uid, st.st_gid)
+        hash_obj.update(head)
         return conf.hash_function(hash_obj.digest())
     else:
+        hash_obj.update(head)
         return hash_obj
 
 
-def get_file_content_checksum(full_path: bytes, st: os.stat_result, conf: SyncConfig) -> Optional[bytes]:
-    # noinspection PyUnusedLocal
-    success = False
-    file_hash_obj = conf.hash_function()
-    if stat.S_ISREG(st.st_mode):
-        buffer = memoryview(bytearray(256 * 1024))
-        with wrap_oserror(full_path):
+def pipelined_read_hash(fp: FileIO, hash_obj):
+    """
+    Hash a large file; a reader thread fills one of two buffers while the other is being hashed
+    Can raise OSError from readinto()
+    """
+    # owned by the calling thread, which waits for the reader before returning
+    buffers = [thread_buffer(BUF_SIZE, i) for i in range(2)]
+    free_queue = queue.Queue()
+    filled_queue = queue.Queue()
+    for i in range(len(buffers)):
+        free_queue.put(i)
+
+    def reader():
+        while True:
+            idx = free_queue.get()
+            if idx is None:
+                return
+            try:
+                n = fp.readinto(buffers[idx])
+            except OSError as e:
+                filled_queue.put(e)
+                return
+            filled_queue.put((idx, n))
+            if not n:
+                return
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        while True:
+            item = filled_queue.get()
+            if isinstance(item, OSError):
+                raise item
+            idx, n = item
+            if not n:
+                break
+            hash_obj.update(buffers[idx][:n])
+            free_queue.put(idx)
+    finally:
+        # stop the reader if we exit early
+        free_queue.put(None)
+        thread.join()
+
+
+def open_noatime(full_path: bytes) -> FileIO:
+    """
+    Open a file for unbuffered reading, with O_NOATIME if possible
+    """
+    if O_NOATIME:
+        try:
             # auto typing is incorrect
             # noinspection PyTypeChecker
-            fp: FileIO = open(full_path, 'rb', buffering=0)
-        with fp:
-            for n in iter(lambda: fp.readinto(buffer), 0):
-                file_hash_obj.update(buffer[:n])
-            success = True
-    elif stat.S_ISLNK(st.st_mode):
-        with wrap_oserror(full_path):
-            file_hash_obj.update(os.readlink(full_path))
-            success = True
+            return open(os.open(full_path, os.O_RDONLY | O_NOATIME), 'rb', buffering=0)
+        except PermissionError:
+            # not the owner; retry without it, which also reports the real error if the file is not readable
+            pass
+    # noinspection PyTypeChecker
+    return open(full_path, 'rb', buffering=0)
+
+
+def hash_regular_file(full_path: bytes, st: os.stat_result, hash_obj) -> bool:
+    # noinspection PyUnusedLocal
+    fp: Optional[FileIO] = None
+    with wrap_oserror(full_path):
+        fp = open_noatime(full_path)
+    if fp is None:
+        return False
+    with fp:
+        if HAS_FADVISE:
+            try:
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        if (st.st_size >= PIPELINE_THRESHOLD and
+                not threading.current_thread().name.startswith(CHECKSUM_THREAD_PREFIX)):
+            # not mmap: a file truncated while it is mapped raises SIGBUS, and backups often read files being written
+            pipelined_read_hash(fp, hash_obj)
+            return True
+        # per-thread since content checksums can be computed in a thread pool
+        buffer = thread_buffer(BUF_SIZE)
+        for n in iter(lambda: fp.readinto(buffer), 0):
+            hash_obj.update(buffer[:n])
+    return True
+
+
+def hash_symlink(full_path: bytes, st: os.stat_result, hash_obj) -> bool:
+    with wrap_oserror(full_path):
+        hash_obj.update(os.readlink(full_path))
+        return True
+    return False
+
+
+# Content hashing by file type (st_mode & S_IFMT_MASK); the content of other file types is empty
+# Each handler returns False if the file cannot be accessed
+CONTENT_HANDLERS = {
+    S_IFREG: hash_regular_file,
+    S_IFLNK: hash_symlink,
+}
+
+
+def get_file_content_checksum(full_path: bytes, st: os.stat_result, conf: SyncConfig) -> Optional[bytes]:
+    cache = conf.checksum_cache
+    if cache is not None:
+        digest = cache.get(full_path, st)
+        if digest is not None:
+            return digest
+    file_hash_obj = conf.new_hash()
+    handler = CONTENT_HANDLERS.get(st.st_mode & S_IFMT_MASK)
+    if handler is not None and not handler(full_path, st, file_hash_obj):
+        return None
+    digest = file_hash_obj.digest()
+    if cache is not None:
+        cache.put(full_path, st, digest)
+    return digest
+
+
+def batch_content_checksums(files: List[Tuple[bytes, os.stat_result, Future]], conf: SyncConfig):
+    """
+    Compute get_file_content_checksum of each file and set the result to the corresponding future
+    """
+    for full_path, st, future in files:
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(get_file_content_checksum(full_path, st, conf))
+        except BaseException as e:
+            future.set_exception(e)
+
+
+class ContentChecksums:
+    """
+    Whole-file checksums needed by one checksum walk
+    If pool is given, content checksums of files in the same directory are computed ahead in parallel
+    Files with multiple hard links are only hashed once per walk
+    """
+    def __init__(self, conf: SyncConfig, pool: Optional[Executor]):
+        self.conf = conf
+        self.pool = pool
+        self.futures: Dict[bytes, Future] = {}
+        self.hard_links: Dict[Tuple[int, int], Future] = {}
+
+    def prefetch(self, files: List[Tuple[bytes, os.stat_result]]):
+        """
+        Submit content checksums of the regular files to the pool so that they are computed ahead of the serial fold
+        files: list of (full_path, stat_result)
+        """
+        if self.pool is None:
+            return
+        regular = [(full_path, st) for full_path, st in files if st.st_mode & S_IFMT_MASK == S_IFREG]
+        if len(regular) < PARALLEL_MIN_FILES:
+            return
+        small: List[Tuple[bytes, os.stat_result, Future]] = []
+        for full_path, st in regular:
+            if st.st_nlink > 1:
+                future = self.hard_links.get((st.st_dev, st.st_ino))
+                if future is not None:
+                    self.futures[full_path] = future
+                    continue
+            if st.st_size < SMALL_FILE_SIZE:
+                future = Future()
+                small.append((full_path, st, future))
+            else:
+                future = self.pool.submit(get_file_content_checksum, full_path, st, self.conf)
+            self.futures[full_path] = future
+            if st.st_nlink > 1:
+                self.hard_links[(st.st_dev, st.st_ino)] = future
+        for i in range(0, len(small), SMALL_FILE_BATCH):
+            self.pool.submit(batch_content_checksums, small[i:i + SMALL_FILE_BATCH], self.conf)
+
+    def get(self, full_path: bytes, st: os.stat_result) -> Optional[bytes]:
+        """
+        Same as get_file_content_checksum, using the prefetched or hard-linked result if any
+        """
+        future = self.futures.pop(full_path, None)
+        if future is None and st.st_nlink > 1:
+            future = self.hard_links.get((st.st_dev, st.st_ino))
+        if future is not None:
+            return future.result()
+        digest = get_file_content_checksum(full_path, st, self.conf)
+        if st.st_nlink > 1:
+            future = Future()
+            future.set_result(digest)
+            self.hard_links[(st.st_dev, st.st_ino)] = future
+        return digest
+
+
+def update_size_mtime(hash_obj, st: os.stat_result, conf: SyncConfig):
+    mtime = st.st_mtime_ns
+    if conf.use_owner:
+        hash_obj.update(SIZE_MTIME_OWNER_STRUCT.pack(st.st_size, 0, mtime & LOW_MASK, mtime >> 64,
+                                                     st.st_uid, st.st_gid))
     else:
-        success = True
-    return file_hash_obj.digest() if success else None
+        hash_obj.update(SIZE_MTIME_STRUCT.pack(st.st_size, 0, mtime & LOW_MASK, mtime >> 64))
 
 
 def one_file_checksum(name: bytes, full_path: bytes, st: os.stat_result, conf: SyncConfig,
-                      second_pass: bool) -> bytes:
+                      second_pass: bool, contents: Optional[ContentChecksums] = None) -> bytes:
     """
     if error, return empty bytes (b'')
+    contents: where to get the content checksum from, if any
     """
     hash_obj = init_file_checksum(name, st, conf)
     if conf.use_file_checksum and second_pass:
-        file_hash = get_file_content_checksum(full_path, st, conf)
+        if contents is not None:
+            file_hash = contents.get(full_path, st)
+        else:
+            file_hash = get_file_content_checksum(full_path, st, conf)
         if file_hash is None:
             return b''
         hash_obj.update(file_hash)
     else:
-        hash_obj.update(st.st_size.to_bytes(16, 'little') + st.st_mtime_ns.to_bytes(16, 'little', signed=True))
-        if conf.use_owner:
-            hash_obj.update(st.st_uid.to_bytes(4, 'little') + st.st_gid.to_bytes(4, 'little'))
+        update_size_mtime(hash_obj, st, conf)
     return hash_obj.digest()
 
 
+def one_file_checksums(name: bytes, full_path: bytes, st: os.stat_result, conf: SyncConfig,
+                       contents: Optional[ContentChecksums] = None) -> Tuple[bytes, bytes]:
+    """
+    one_file_checksum of both passes with conf.use_file_checksum, hashing the common header once
+    """
+    hash_obj = init_file_checksum(name, st, conf)
+    second_hash = hash_obj.copy()
+    update_size_mtime(hash_obj, st, conf)
+    if contents is not None:
+        file_hash = contents.get(full_path, st)
+    else:
+        file_hash = get_file_content_checksum(full_path, st, conf)
+    if file_hash is None:
+        return hash_obj.digest(), b''
+    second_hash.update(file_hash)
+    return hash_obj.digest(), second_hash.digest()
+
+
+def list_directory(full_path: bytes) -> Optional[List[Tuple[os.DirEntry, os.stat_result]]]:
+    """
+    List and stat the children of a directory, sorted by name
+    return None if the directory cannot be listed
+    """
+    # noinspection PyUnusedLocal
+    scan = None
+    with wrap_oserror(full_path):
+        scan = os.scandir(full_path)
+    if scan is None:
+        return None
+    with scan as it:
+        lst: List[os.DirEntry] = sorted(it, key=operator.attrgetter('name'))
+    children: List[Tuple[os.DirEntry, os.stat_result]] = []
+    for f in lst:
+        with wrap_oserror(f.path):
+            if USE_DIRENTRY_STAT:
+                children.append((f, f.stat(follow_symlinks=False)))
+            else:
+                children.append((f, os.stat(f.path, follow_symlinks=False)))
+    return children
+
+
+def open_directory(name: bytes, full_path: bytes, st: os.stat_result, conf: SyncConfig,
+                   contents: Optional[ContentChecksums], listings: Optional[Listings]) -> Optional[DirectoryFrame]:
+    """
+    Start the checksum of a directory: list and stat its children and prefetch their content checksums
+    return None if the directory cannot be listed
+    """
+    hash_obj = init_file_checksum(name, st, conf)
+    children = listings.get(full_path) if listings is not None else None
+    if children is None:
+        children = list_directory(full_path)
+        if children is None:
+            return None
+        if listings is not None:
+            listings[full_path] = children
+    if contents is not None:
+        contents.prefetch([(f.path, f_st) for f, f_st in children])
+    # reversed so that popping from the end yields children in sorted order
+    return hash_obj, children[::-1]
+
+
+def leaf_checksum(name: bytes, full_path: bytes, st: os.stat_result, conf: SyncConfig, second_pass: bool,
+                  result: Optional[ChecksumWalkResult], contents: Optional[ContentChecksums]) -> bytes:
+    res = one_file_checksum(name, full_path, st, conf, second_pass, contents)
+    if not res:
+        return b''
+    if result:
+        result.total_size += st.st_size
+        result.total_files += 1
+        if st.st_nlink > 1:
+            result.hard_link_map[(st.st_dev, st.st_ino)] = full_path
+    return res
+
+
 def file_checksum(name: bytes, full_path: bytes, st: os.stat_result, conf: SyncConfig,
-                  second_pass: bool, result: Optional[ChecksumWalkResult] = None) -> bytes:
+                  second_pass: bool, result: Optional[ChecksumWalkResult] = None,
+                  contents: Optional[ContentChecksums] = None, listings: Optional[Listings] = None) -> bytes:
     """
     Can raise OSError from open(), os.scandir() or os.readlink()
+    contents: where to get content checksums from; see ContentChecksums
+    listings: see checksum_walk
     """
-    if stat.S_ISDIR(st.st_mode):
-        hash_obj = init_file_checksum(name, st, conf)
-        # noinspection PyUnusedLocal
-        scan = None
-        with wrap_oserror(full_path):
-            scan = os.scandir(full_path)
-        if scan is None:
-            # Because of the signature definition,
-            # returning empty byte string effectively ignores the directory
-            return b''
-        with scan as it:
-            lst: List[os.DirEntry] = sorted(it, key=lambda x: x.name)
-            for f in lst:
-                with wrap_oserror(f.path):
-                    # DirEntry.stat seems to give different st_mode result from f.stat
-                    # f_st = f.stat(follow_symlinks=False)
-                    f_st = os.stat(f.path, follow_symlinks=False)
-                    sig = file_checksum(f.name, f.path, f_st, conf, second_pass, result)
-                    hash_obj.update(sig)
+    if st.st_mode & S_IFMT_MASK != S_IFDIR:
+        return leaf_checksum(name, full_path, st, conf, second_pass, result, contents)
+    # Walk the directory tree in post-order with an explicit stack instead of recursion
+    frame = open_directory(name, full_path, st, conf, contents, listings)
+    if frame is None:
+        # Because of the signature definition,
+        # returning empty byte string effectively ignores the directory
+        return b''
+    stack: List[DirectoryFrame] = [frame]
+    # Bind globals used once per entry to locals to save the lookups in this loop
+    push = stack.append
+    while True:
+        hash_obj, children = stack[-1]
+        if children:
+            f, f_st = children.pop()
+            with wrap_oserror(f.path):
+                if f_st.st_mode & S_IFMT_MASK == S_IFDIR:
+                    frame = open_directory(f.name, f.path, f_st, conf, contents, listings)
+                    if frame is not None:
+                        push(frame)
+                else:
+                    hash_obj.update(leaf_checksum(f.name, f.path, f_st, conf, second_pass, result, contents))
+            continue
+        stack.pop()
         if result:
             result.total_files += 1
-        return hash_obj.digest()
-    else:
-        res = one_file_checksum(name, full_path, st, conf, second_pass)
-        if not res:
-            return b''
-        if result:
-            result.total_size += st.st_size
-            result.total_files += 1
-            if st.st_nlink > 1:
-                result.hard_link_map[(st.st_dev, st.st_ino)] = full_path
-        return res
+        if not stack:
+            return hash_obj.digest()
+        stack[-1][0].update(hash_obj.digest())
 
 
 def checksum_walk(names: List[Tuple[bytes, os.stat_result]], path: bytes, conf: SyncConfig,
-                  second_pass: bool, result: Optional[ChecksumWalkResult] = None) -> str:
+                  second_pass: bool, result: Optional[ChecksumWalkResult] = None,
+                  listings: Optional[Listings] = None) -> str:
     """
     Checksum of a file S(file) :=
       H(conf.head_bytes() + file.name + file.st_mode.to_bytes(4, 'little') +
@@ -133,9 +456,26 @@ def checksum_walk(names: List[Tuple[bytes, os.stat_result]], path: bytes, conf:
     Note: all hashed content contains at most one variable-length input
 
     names: list of (name, stat_result)
+    listings: if given, the listings of subdirectories are taken from it instead of listing and stat'ing them again,
+      and the ones not in it are added; pass the same dict to both passes over the same names
+    """
+    names.sort(key=operator.itemgetter(0))
+    if not (conf.use_file_checksum and second_pass):
+        return checksum_walk_contents(names, path, conf, second_pass, result, None, listings)
+    pool = checksum_pool(conf.checksum_threads) if conf.checksum_threads > 1 else None
+    return checksum_walk_contents(names, path, conf, second_pass, result, ContentChecksums(conf, pool), listings)
+
+
+def checksum_walk_contents(names: List[Tuple[bytes, os.stat_result]], path: bytes, conf: SyncConfig,
+                           second_pass: bool, result: Optional[ChecksumWalkResult],
+                           contents: Optional[ContentChecksums], listings: Optional[Listings] = None) -> str:
+    """
+    names already sorted
     """
-    names.sort(key=lambda x: x[0])
-    hash_obj = conf.hash_function()
-    for name, st in names:
-        hash_obj.update(file_checksum(name, os.path.join(path, name), st, conf, second_pass, result))
+    hash_obj = conf.new_hash()
+    full_paths = [join_path(path, name) for name, _ in names]
+    if contents is not None:
+        contents.prefetch([(full_path, st) for full_path, (_, st) in zip(full_paths, names)])
+    for full_path, (name, st) in zip(full_paths, names):
+        hash_obj.update(file_checksum(name, full_path, st, conf, second_pass, result, contents, listings))
     return hash_obj.hexdigest()
@@ -5,8 +5,25 @@ import re
 import sys
 
 from .config import SyncConfig, UploadConfig, DownloadConfig
-from .upload import upload
-from .download import download
+
+RESERVED_PREFIX_RE = re.compile(r'[0-9A-Z_]*')
+COMPRESSION_SUFFIX_RE = re.compile(r'[0-9a-zA-Z_.]*')
+# running in Windows outside of Git Bash / MSYS2
+WARN_WINDOWS = os.name == 'nt' and 'MSYSTEM' not in os.environ
+# log level for each -v count
+VERBOSITY_LEVELS = (logging.WARNING, logging.INFO, logging.DEBUG)
+GROUPING_ORDERS = frozenset(('size', 'mtime', 'ctime', 'name'))
+# sync options copied as-is to the SyncConfig attribute of the same name
+SYNC_FLAG_OPTIONS = ('dest_as_empty', 'use_file_checksum', 'use_directory_mtime', 'use_owner', 'dry_run',
+                     'ignore_errors', 'metadata_path', 'use_rclone_rcd')
+# sync options copied to the SyncConfig attribute if specified; option name -> attribute name
+SYNC_OPTIONAL_OPTIONS = {'tar_path': 'tar_command', 'rclone_path': 'rclone_command',
+                         'checksum_threads': 'checksum_threads', 'transfer_threads': 'transfer_threads',
+                         'reserved_prefix': 'reserved_prefix'}
+# the same for UploadConfig
+UPLOAD_FLAG_OPTIONS = ('delete_after_upload', 'checksum_cache_path')
+UPLOAD_OPTIONAL_OPTIONS = {'file_base_bytes': 'file_base_bytes', 'merge_threshold': 'merge_threshold',
+                           'grouping_order': 'grouping_order', 'stat_threads': 'stat_threads'}
 
 
 def get_parser():
@@ -32,7 +49,20 @@ def get_parser():
                             help="Update a file if its ownership changed")
         parser.add_argument('--checksum-choice', metavar='hashfn',
                             help="The program hashes timestamps, filenames and other information in an aggregated file "
-                                 "into a single checksum using this checksum function. Default: sha1")
+                                 "into a single checksum using this checksum function. "
+                                 "Any hashlib algorithm, blake3 if the blake3 package is installed, or "
+                                 "xxh32, xxh64, xxh3_64, xxh3_128 (fast but not collision-resistant against crafted "
+                                 "files) if the xxhash package is installed. "
+                                 "Specify 'auto' to keep the function of the existing upload, or to use blake3 if "
+                                 "installed for a new one. "
+                                 "Default: sha1")
+        parser.add_argument('--checksum-threads', type=positive_int, metavar='n',
+                            help="Number of threads used to compute whole-file checksums. "
+                                 "Default: the number of CPUs")
+        parser.add_argument('--transfer-threads', type=positive_int, metavar='n',
+                            help="Maximum number of tarballs transferred concurrently; each transfer runs its own "
+                                 "tar and rclone processes. Use 1 to transfer one at a time. "
+                                 "Default: 4 (the same as rclone's --transfers)")
         parser.add_argument('--ignore-errors', action='store_true',
                             help="Suppress non-zero exit code (we emit a warning, exit with non-zero at the end and "
                                  "treat the file that caused the error as nonexistent (if applicable) if "
@@ -40,42 +70,64 @@ def get_parser():
         parser.add_argument('--rclone-args', metavar='args...',
                             help='Additional arguments passed to rclone')
         # specify 'none' for no compression
-        parser.add_argument('-I', '--use-compress-program', metavar='prog[ args...]',
+        parser.add_argument('-I', '--use-compress-program', type=compress_program, metavar='prog[ args...]',
                             help="Compression program (passed to tar's -I option); "
                                  "specify 'none' to disable compression. "
+                                 "Specify 'auto' to keep the compression of the existing upload, or to use "
+                                 "multithreaded zstd or pigz if installed for a new one, when uploading; and to "
+                                 "choose by the suffix of each uploaded file when downloading. "
                                  "Must use the same compress program for upload and download. "
                                  "Default: gzip")
+        parser.add_argument('--rclone-rcd', dest='use_rclone_rcd', action='store_true',
+                            help="Start one `rclone rcd` and delete remote files through its API "
+                                 "instead of starting rclone for each deletion")
         parser.add_argument('--tar-path', metavar='path', help="The path to tar program")
         parser.add_argument('--rclone-path', metavar='path', help="The path to rclone program")
         parser.add_argument('--metadata-path', metavar='path',
                             help="The path to metadata file; can be a local path or a remote path. "
                                  "Defaults to _METARCLONE_META.json.gz under the remote path. "
+                                 "A path ending with .zst is compressed with zstd (requires the zstandard package). "
                                  "This file stores information of the current status of remote files, "
                                  "so it must be instant retrievable. Full re-sync is needed if this file is lost.")
-        parser.add_argument('--reserved-prefix', metavar='prefix')
+        parser.add_argument('--reserved-prefix', type=reserved_prefix, metavar='prefix')
+
+    # the sync arguments are defined once and copied into both subparsers
+    sync_parser = argparse.ArgumentParser(add_help=False)
+    add_sync_arguments(sync_parser)
 
     upload_parser = subparsers.add_parser('upload', usage="metarclone upload [-h] [options...] local remote",
-                                          help="Upload to rclone remote")
-    add_sync_arguments(upload_parser)
+                                          help="Upload to rclone remote", parents=[sync_parser])
     upload_parser.add_argument('--file-base-bytes', type=int, metavar='bytes',
                                help="Add this size to each file and directory when calculating file size "
                                     "for aggregation. Default: 64")
-    upload_parser.add_argument('--merge-threshold', metavar='size',
+    upload_parser.add_argument('--merge-threshold', type=size_bytes, metavar='size',
                                help="Merge files or directories smaller than this threshold into larger files. "
                                     "Use K,M,G,T suffix (case-insensitive) to indicate KiB,MiB,GiB,TiB. "
                                     "A directory will contain at most one aggregated file smaller than this threshold. "
                                     "Default: 10M")
-    upload_parser.add_argument('--s3-min-chunk-size', metavar='size',
+    upload_parser.add_argument('--s3-min-chunk-size', type=size_bytes, metavar='size',
                                help="Minimum S3 upload chunk size. "
                                     "(Do not specify --s3-chunk-size using --rclone-args, since metarclone "
                                     "will increase chunk size automatically if the upload file size is large)")
+    upload_parser.add_argument('--rclone-upload-args', metavar='args...',
+                               help="Additional arguments passed to rclone when uploading tarballs, "
+                                    "e.g. '--drive-chunk-size=64M'. Larger chunks upload faster to object storage "
+                                    "but are buffered in memory by each of the concurrent uploads "
+                                    "(see --transfer-threads)")
+    upload_parser.add_argument('--stat-threads', type=positive_int, metavar='n',
+                               help="Number of threads used to stat files in large directories. "
+                                    "Useful on network filesystems and hard disks. Default: 1")
+    upload_parser.add_argument('--checksum-cache', dest='checksum_cache_path', metavar='path',
+                               help="Cache whole-file checksums in this local file, and skip reading files whose "
+                                    "size, mtime, ctime and inode are unchanged since the last run. "
+                                    "Only used with --use-file-checksum")
     upload_parser.add_argument('--delete-before-upload', dest='delete_after_upload', action='store_false',
                                help="Delete remote unused files before upload "
                                     "(default is deleting them after completing upload)")
-    upload_parser.add_argument('--grouping-order', metavar='order',
+    upload_parser.add_argument('--grouping-order', choices=sorted(GROUPING_ORDERS), metavar='order',
                                help="Group files smaller than threshold using this order. "
                                     "Possible choices: size, name, ctime, mtime. Default: size")
-    upload_parser.add_argument('--compression-suffix', metavar='suffix',
+    upload_parser.add_argument('--compression-suffix', type=compression_suffix, metavar='suffix',
                                help="The file suffix of compressed tarballs. "
                                     "The program will try to deduct it if -I is specified. Default: .gz")
     # specified by relative path from upload root or absolute path
@@ -90,8 +142,7 @@ def get_parser():
     upload_parser.set_defaults(func=upload_func)
 
     download_parser = subparsers.add_parser('download', usage="metarclone download [-h] [options...] remote local",
-                                            help='Download from rclone remote')
-    add_sync_arguments(download_parser)
+                                            help='Download from rclone remote', parents=[sync_parser])
     download_parser.add_argument('remote', help="Remote base path")
     download_parser.add_argument('local', help="Local base path")
     download_parser.set_defaults(func=download_func)
@@ -100,77 +151,130 @@ def get_parser():
 
 
 def parse_size_bytes(x: str):
-    suffix_map = {'': 1024, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
-    match = re.fullmatch(r'(\d+(?:\.\d+)?)([bkmgt]?)', x.lower())
-    if not match:
+    """
+    Parse <digits>[.<digits>][unit], where unit is one of b,k,m,g,t (case-insensitive; default k)
+    """
+    x = x.lower()
+    number, unit = (x, '') if x[-1:].isdecimal() else (x[:-1], x[-1:])
+    if unit == '' or unit == 'k':
+        multiplier = 1024
+    elif unit == 'b':
+        multiplier = 1
+    elif unit == 'm':
+        multiplier = 1024 ** 2
+    elif unit == 'g':
+        multiplier = 1024 ** 3
+    elif unit == 't':
+        multiplier = 1024 ** 4
+    else:
+        raise ValueError(f'Invalid size unit: {unit}')
+    integer, dot, fraction = number.partition('.')
+    if not integer.isdecimal() or (dot and not fraction.isdecimal()):
         raise ValueError('Invalid size pattern.')
-    return int(float(match[1]) * suffix_map[match[2]])
+    if not dot:
+        # exact for integers of any size
+        return int(integer) * multiplier
+    return int(float(number) * multiplier)
+
+
+# argparse type functions; they validate and convert option values so that errors are reported by the parser
+def size_bytes(x: str) -> int:
+    try:
+        return parse_size_bytes(x)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def compress_program(x: str) -> str:
+    # '' (rather than None, which means not specified) for no compression
+    return '' if x == 'none' else x
+
+
+def positive_int(x: str) -> int:
+    if not x.isdecimal() or int(x) < 1:
+        raise argparse.ArgumentTypeError(f'should be a positive integer: {x}')
+    return int(x)
+
+
+def reserved_prefix(x: str) -> str:
+    if not RESERVED_PREFIX_RE.fullmatch(x):
+        raise argparse.ArgumentTypeError("should only contain upper-case alphanumeric characters or '_'")
+    return x
+
+
+def compression_suffix(x: str) -> str:
+    if not COMPRESSION_SUFFIX_RE.fullmatch(x):
+        raise argparse.ArgumentTypeError("should only contain alphanumeric characters, '.' or '_'")
+    return x
+
+
+def warn_s3_chunk_size(rclone_args: str, option: str):
+    if 's3-chunk-size' in rclone_args:
+        logging.warning(f"Specifying --s3-chunk-size using {option} will likely make large uploads fail; "
+                        "use --s3-min-chunk-size instead.")
 
 
 def populate_sync_config(args: argparse.Namespace, conf: SyncConfig):
-    if args.verbose == 0:
-        logging.getLogger().setLevel(logging.WARNING)
-    elif args.verbose == 1:
-        logging.getLogger().setLevel(logging.INFO)
-    else:
-        logging.getLogger().setLevel(logging.DEBUG)
-
-    conf.dest_as_empty = args.dest_as_empty
-    conf.use_file_checksum = args.use_file_checksum
-    conf.use_directory_mtime = args.use_directory_mtime
-    conf.dry_run = args.dry_run
-    conf.use_owner = args.use_owner
-    if args.checksum_choice is not None:
-        conf.set_hash_function(args.checksum_choice)
-    conf.ignore_errors = args.ignore_errors
-    if args.rclone_args is not None:
-        if 's3-chunk-size' in args.rclone_args:
-            logging.warning("Specifying --s3-chunk-size using --rclone-args will likely make large uploads fail.")
-        conf.rclone_args = args.rclone_args.split()
-    if args.use_compress_program is not None:
-        conf.compression = args.use_compress_program
-    if conf.compression == 'none':
-        conf.compression = None
-    if args.tar_path is not None:
-        conf.tar_command = args.tar_path
-    if args.rclone_path is not None:
-        conf.rclone_command = args.rclone_path
-    if args.reserved_prefix is not None:
-        if not re.fullmatch(r'[0-9A-Z_]*', args.reserved_prefix):
-            raise ValueError("Reserved prefix should only contain upper-case alphanumeric characters or '_'.")
-        conf.reserved_prefix = args.reserved_prefix
-    conf.metadata_path = args.metadata_path
+    logging.getLogger().setLevel(VERBOSITY_LEVELS[min(args.verbose, len(VERBOSITY_LEVELS) - 1)])
+
+    for name in SYNC_FLAG_OPTIONS:
+        setattr(conf, name, getattr(args, name))
+    for name, attr in SYNC_OPTIONAL_OPTIONS.items():
+        value = getattr(args, name)
+        if value is not None:
+            setattr(conf, attr, value)
+    checksum_choice = args.checksum_choice
+    if checksum_choice is not None:
+        conf.set_hash_function(checksum_choice)
+    rclone_args = args.rclone_args
+    if rclone_args is not None:
+        warn_s3_chunk_size(rclone_args, '--rclone-args')
+        conf.rclone_args = rclone_args.split()
+    compression = args.use_compress_program
+    if compression is not None:
+        conf.compression = compression or None
     conf.convert_command_to_abs_path()
 
 
 def upload_func(args: argparse.Namespace):
+    # imported here so that argument errors and --help do not pay for loading the sync modules
+    from . import upload
+    from .metadata import metadata_uses_zstd, HAS_ZSTD
     conf = UploadConfig()
     populate_sync_config(args, conf)
-    if args.file_base_bytes is not None:
-        conf.file_base_bytes = args.file_base_bytes
-    if args.merge_threshold is not None:
-        conf.merge_threshold = parse_size_bytes(args.merge_threshold)
-    if args.s3_min_chunk_size is not None:
-        conf.s3_min_chunk_size_kib = parse_size_bytes(args.s3_min_chunk_size) // 1024
-    conf.delete_after_upload = args.delete_after_upload
-    if args.grouping_order is not None:
-        if args.grouping_order not in ['size', 'mtime', 'ctime', 'name']:
-            raise ValueError('Invalid grouping order.')
-        conf.grouping_order = args.grouping_order
-    if args.compression_suffix is not None:
-        if not re.fullmatch(r'[0-9a-zA-Z_.]*', args.compression_suffix):
-            raise ValueError("Compression suffix should only contain alphanumeric characters, '.' or '_'.")
-        conf.compression_suffix = args.compression_suffix
+    for name in UPLOAD_FLAG_OPTIONS:
+        setattr(conf, name, getattr(args, name))
+    for name, attr in UPLOAD_OPTIONAL_OPTIONS.items():
+        value = getattr(args, name)
+        if value is not None:
+            setattr(conf, attr, value)
+    rclone_upload_args = args.rclone_upload_args
+    if rclone_upload_args is not None:
+        warn_s3_chunk_size(rclone_upload_args, '--rclone-upload-args')
+        conf.rclone_upload_args = rclone_upload_args.split()
+    if conf.metadata_path is not None and metadata_uses_zstd(conf.metadata_path) and not HAS_ZSTD:
+        raise ValueError('Metadata path with .zst suffix requires the zstandard package')
+    s3_min_chunk_size = args.s3_min_chunk_size
+    if s3_min_chunk_size is not None:
+        conf.s3_min_chunk_size_kib = s3_min_chunk_size // 1024
+    compression_suffix = args.compression_suffix
+    if conf.compression == 'auto':
+        # resolved against the existing upload in upload(); see UploadConfig.resolve_auto_compression
+        if compression_suffix is not None:
+            raise ValueError('--compression-suffix cannot be used with -I auto')
+    elif compression_suffix is not None:
+        conf.compression_suffix = compression_suffix
     else:
         if not conf.deduct_compression_suffix():
             raise ValueError('Unknown compression; please specify --compression-suffix')
 
     src: bytes = os.path.normpath(args.local).encode()
     dest: str = args.remote
-    if args.include_file:
-        conf.set_include_list(src, map(lambda x: x.encode(), args.include_file))
-    if args.exclude_file:
-        conf.set_exclude_list(src, map(lambda x: x.encode(), args.exclude_file))
+    include_file, exclude_file = args.include_file, args.exclude_file
+    if include_file:
+        conf.set_include_list(src, (i.encode() for i in include_file))
+    if exclude_file:
+        conf.set_exclude_list(src, (i.encode() for i in exclude_file))
     result = upload(src, dest, conf)
 
     if args.stats:
@@ -187,6 +291,7 @@ def upload_func(args: argparse.Namespace):
 
 
 def download_func(args: argparse.Namespace):
+    from . import download
     conf = DownloadConfig()
     populate_sync_config(args, conf)
 
@@ -206,10 +311,9 @@ def cli_entry():
     parser = get_parser()
     args = parser.parse_args()
     try:
-        if os.name == 'nt':
-            if 'MSYSTEM' not in os.environ:
-                logging.warning('Running directly in Windows is not supported. This command is likely going to fail. '
-                                'Please install Git Bash or MSYS2 and run inside it.')
+        if WARN_WINDOWS:
+            logging.warning('Running directly in Windows is not supported. This command is likely going to fail. '
+                            'Please install Git Bash or MSYS2 and run inside it.')
         args.func(args)
     except ValueError as e:
         import traceback
@@ -1,24 +1,140 @@
 import os
+import functools
 import hashlib
+import operator
 import shutil
-from typing import Set, Iterable, List, Optional
+from types import MappingProxyType
+from typing import Dict, Iterable, Sequence, List, Optional, Tuple, Callable
 
+from metarclone.cache import ChecksumCache
 from metarclone.utils import cmd_to_abs_path
 
+# All possible results of SyncConfig.head_bytes, indexed by the first byte; it is computed for every hashed file
+HEAD_BYTES = tuple(bytes([i, 0, 0, 0]) for i in range(8))
+SEP = os.sep.encode()
+ALTSEP = (os.altsep or os.sep).encode()
+XXHASH_ALGORITHMS = ('xxh32', 'xxh64', 'xxh3_64', 'xxh3_128')
+# compression program -> suffix of the compressed tarball; see UploadConfig.deduct_compression_suffix
+COMPRESSION_SUFFIXES = MappingProxyType({
+    'gzip': '.gz', 'gunzip': '.gz', 'pigz': '.gz',
+    'bzip2': '.bz2', 'bunzip2': '.bz2', 'pbzip2': '.bz2',
+    'xz': '.xz', 'unxz': '.xz',
+    'zstd': '.zst', 'unzstd': '.zst', 'pzstd': '.zst',
+})
+# candidates of compression 'auto' for upload, in order of preference; the first two compress with all CPUs, so
+#   the compressor does not become the bottleneck of the tar pipeline
+AUTO_COMPRESSIONS = ('zstd -T0 -3 --long=27', 'pigz', 'gzip')
+# suffix of the compressed tarball -> decompression program; used by compression 'auto'
+SUFFIX_COMPRESSIONS = MappingProxyType({'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz', '.zst': 'zstd', '': None})
+# candidates of hash function 'auto', in order of preference; blake3 hashes file contents several times faster
+AUTO_HASH_FUNCTIONS = ('blake3', 'sha1')
+# hashlib algorithms that have a named constructor (e.g. hashlib.sha1)
+HASHLIB_ATTRS = frozenset(dir(hashlib))
+
+
+@functools.lru_cache(maxsize=None)
+def hash_constructor(name: str) -> Callable:
+    """
+    Resolve a hash function name to a constructor called with the data to hash, like hashlib.sha1
+    Cached, so that configs using the same name share the same constructor object (see SyncConfig.hash_prefix)
+    """
+    if name == 'blake3':
+        # optional backend; hashes large inputs with multiple threads and SIMD
+        try:
+            import blake3
+        except ImportError:
+            raise NameError('Hash function blake3 requires the blake3 package') from None
+        return functools.partial(blake3.blake3, max_threads=blake3.blake3.AUTO)
+    if name in XXHASH_ALGORITHMS:
+        # optional backend; much faster, but not collision-resistant against intentionally crafted files
+        try:
+            import xxhash
+        except ImportError:
+            raise NameError(f'Hash function {name} requires the xxhash package') from None
+        return getattr(xxhash, name)
+    if name not in hashlib.algorithms_available:
+        raise NameError('Hash function not found')
+    if name in HASHLIB_ATTRS:
+        return getattr(hashlib, name)
+    return functools.partial(hashlib.new, name)
+
+
+def tarball_suffix(tarball_name: str) -> str:
+    """
+    The compression suffix of an uploaded tarball name, e.g. '.gz' for _METARCLONE_00000.tar.gz
+    """
+    return tarball_name[tarball_name.index('.tar') + 4:]
+
+
+def path_components(path: bytes, base: Sequence[bytes] = ()) -> List[bytes]:
+    """
+    Split a normalized form of path into components, like os.path.normpath followed by splitting on separators
+    Relative paths are resolved against the components in base; absolute paths start with a component of the drive
+      and separator
+    """
+    drive = b''
+    if os.altsep:
+        # Windows; split the drive once here instead of per component
+        drive, path = os.path.splitdrive(path.replace(ALTSEP, SEP))
+    if path.startswith(SEP) or drive:
+        res = [drive + SEP if path.startswith(SEP) else drive]
+        root = 1
+    else:
+        res = list(base)
+        root = 0
+    for component in path.split(SEP):
+        if component == b'..':
+            if len(res) > root and res[-1] != b'..':
+                res.pop()
+            elif not root:
+                res.append(component)
+        elif component and component != b'.':
+            res.append(component)
+    return res
+
+
+def head_bytes_flag(attr: str) -> property:
+    """
+    A SyncConfig flag that head_bytes depends on, stored in the slot attr; assigning it resets the cached head_bytes
+    """
+    def setter(self: 'SyncConfig', value: bool):
+        setattr(self, attr, value)
+        self._head_bytes = None
+    return property(operator.attrgetter(attr), setter)
+
 
 class SyncConfig:
+    __slots__ = ('dest_as_empty', '_use_file_checksum', '_use_owner', '_use_directory_mtime',
+                 'hash_function', 'hash_name',
+                 'checksum_threads', 'transfer_threads', 'checksum_cache_path', 'checksum_cache',
+                 'ignore_errors', 'rclone_args', 'use_rclone_rcd', 'compression', 'tar_command', 'rclone_command',
+                 'reserved_prefix', 'metadata_path', 's3_min_chunk_size_kib', 'dry_run',
+                 '_head_bytes', '_hash_prefix_cache', '_hash_template')
+
     def __init__(self):
         # if True, treat destination as empty; that is, upload / download without checking checksums and existing files
         self.dest_as_empty = False
         self.use_file_checksum = False
         self.use_owner = False
         self.use_directory_mtime = False
-        self.hash_function = hashlib.sha1
+        self.hash_function: Callable = hashlib.sha1
+        # the name passed to set_hash_function; stored in metadata
+        self.hash_name = 'sha1'
+        # number of threads used to compute whole-file checksums; 1 to disable the thread pool
+        self.checksum_threads = os.cpu_count() or 1
+        # maximum number of concurrent rclone / tar pipelines; each holds its own buffers, file descriptors and remote
+        #   connection, so the default matches rclone's own --transfers default instead of scaling with the CPUs
+        self.transfer_threads = 4
+        # local file caching whole-file checksums across runs, keyed by path, size, mtime, ctime and inode
+        self.checksum_cache_path: Optional[str] = None
+        self.checksum_cache: Optional[ChecksumCache] = None
         # We emit a warning, exit with non-zero at the end and treat the file that caused the error as nonexistent
         #   (if applicable) if any non-fatal error occurred.
         #   Use ignore_errors to suppress the non-zero exit code.
         self.ignore_errors = False
         self.rclone_args: List[str] = []
+        # send deletions to one long-lived `rclone rcd` instead of starting rclone for each of them
+        self.use_rclone_rcd = False
         self.compression: Optional[str] = 'gzip'  # passed to tar's -I option
         self.tar_command = 'tar'
         self.rclone_command = 'rclone'
@@ -26,24 +142,70 @@ class SyncConfig:
         self.metadata_path: Optional[str] = None
         self.s3_min_chunk_size_kib = 5 * 1024
         self.dry_run = False
+        # cached result of head_bytes; reset by the setters of the flags it depends on (see head_bytes_flag)
+        self._head_bytes: Optional[bytes] = None
+        # (hash_function, head_bytes()) -> hash object that has absorbed head_bytes(); see hash_prefix
+        self._hash_prefix_cache: Optional[Tuple[Tuple[Callable, bytes], object]] = None
+        # (hash_function, empty hash object); see new_hash
+        self._hash_template: Optional[Tuple[Callable, object]] = None
         # TODO: add allowed device list (same_fs bool and fs_num int)
         # TODO: allow encode_child/decode_child to be something other than base32
 
+    use_file_checksum = head_bytes_flag('_use_file_checksum')
+    use_owner = head_bytes_flag('_use_owner')
+    use_directory_mtime = head_bytes_flag('_use_directory_mtime')
+
     def head_bytes(self):
-        first_byte = (
-            (1 << 0 if self.use_file_checksum else 0) |
-            (1 << 1 if self.use_owner else 0) |
-            (1 << 2 if self.use_directory_mtime else 0)
-        )
-        return bytes([first_byte, 0, 0, 0])
+        if self._head_bytes is None:
+            first_byte = (
+                (1 << 0 if self.use_file_checksum else 0) |
+                (1 << 1 if self.use_owner else 0) |
+                (1 << 2 if self.use_directory_mtime else 0)
+            )
+            self._head_bytes = HEAD_BYTES[first_byte]
+        return self._head_bytes
+
+    def hash_prefix(self):
+        """
+        A hash object that has absorbed head_bytes(); copy it to start a checksum prefixed by head_bytes(),
+          which is cheaper than constructing a new hash object
+        The returned object must not be updated
+        """
+        key = (self.hash_function, self.head_bytes())
+        if self._hash_prefix_cache is None or self._hash_prefix_cache[0] != key:
+            self._hash_prefix_cache = (key, self.hash_function(key[1]))
+        return self._hash_prefix_cache[1]
+
+    def new_hash(self):
+        """
+        A new empty hash object, like hash_function(); copying a cached empty one is cheaper than constructing it
+        """
+        template = self._hash_template
+        if template is None or template[0] is not self.hash_function:
+            template = self._hash_template = (self.hash_function, self.hash_function())
+        return template[1].copy()
 
     def set_hash_function(self, name: str):
-        if name not in hashlib.algorithms_available:
-            raise NameError('Hash function not found')
-        if name in dir(hashlib):
-            self.hash_function = getattr(hashlib, name)
-        else:
-            self.hash_function = hashlib.new(name)
+        if name == 'auto':
+            # resolved by resolve_auto_hash_function once the remote metadata is loaded
+            self.hash_name = name
+            return
+        self.hash_function = hash_constructor(name)
+        self.hash_name = name
+
+    def resolve_auto_hash_function(self, recorded: Optional[str] = None):
+        """
+        Replace hash function 'auto' by recorded (the one in the remote metadata) if it is available, so that the
+          remote checksums stay comparable, or else by the first available one in AUTO_HASH_FUNCTIONS
+        """
+        if self.hash_name != 'auto':
+            return
+        for name in ((recorded,) if recorded else ()) + AUTO_HASH_FUNCTIONS:
+            try:
+                self.set_hash_function(name)
+                return
+            except NameError:
+                pass
 
     def convert_command_to_abs_path(self):
         # In MinGW/Windows, direct exec will not use the PATH variable to find the executable properly,
@@ -53,6 +215,9 @@ class SyncConfig:
 
 
 class UploadConfig(SyncConfig):
+    __slots__ = ('metadata_version', 'file_base_bytes', 'merge_threshold', 'delete_after_upload', 'grouping_order',
+                 'compression_suffix', 'stat_threads', 'rclone_upload_args', 'include_tree', 'exclude_tree')
+
     def __init__(self):
         super().__init__()
         self.metadata_version = 1  # reserved for future use
@@ -61,10 +226,34 @@ class UploadConfig(SyncConfig):
         self.delete_after_upload = True
         self.grouping_order = 'size'
         self.compression_suffix = '.gz'
-        # these lists should be already joined with base path and without ending slash
-        # include_list should have all possible prefixes in the set
-        self.include_list: Set[bytes] = set()
-        self.exclude_list: Set[bytes] = set()
+        # number of threads used to stat the children of large directories; 1 to disable the thread pool
+        # only pays off when stat waits on the device or the network, so it is off by default
+        self.stat_threads = 1
+        # extra rclone arguments for uploading tarballs only, e.g. chunk sizes of the backend
+        # each upload holds its chunks in memory, and up to transfer_threads uploads run at once
+        self.rclone_upload_args: List[str] = []
+        # tries of the include / exclude paths joined with base path, split by path_components
+        # an excluded path maps to None in exclude_tree; see included_children and excluded_children
+        self.include_tree: Dict[bytes, dict] = {}
+        self.exclude_tree: Dict[bytes, Optional[dict]] = {}
+
+    def resolve_auto_compression(self, recorded: Optional[Tuple[str, str]] = None):
+        """
+        Replace compression 'auto' and set the suffix
+        recorded: (compression program or 'none', tarball suffix) of the existing upload; it is kept if the program is
+          installed, so that the tarballs of a remote do not mix compressions; otherwise the first program in
+          AUTO_COMPRESSIONS that is installed is used
+        """
+        if self.compression != 'auto':
+            return
+        if recorded is not None:
+            program, suffix = recorded
+            if program == 'none' or shutil.which(program.split()[0]):
+                self.compression = None if program == 'none' else program
+                self.compression_suffix = suffix
+                return
+        self.compression = next((i for i in AUTO_COMPRESSIONS if shutil.which(i.split()[0])), 'gzip')
+        self.deduct_compression_suffix()
 
     def deduct_compression_suffix(self) -> bool:
         if self.compression == 'none' or not self.compression:
@@ -75,26 +264,66 @@ class UploadConfig(SyncConfig):
         if not compress_cmd:
             return False
         compression = compress_cmd[0]
-        compression_map = {'gzip': '.gz', 'gunzip': '.gz', 'pigz': '.gz',
-                           'bzip2': '.bz2', 'bunzip2': '.bz2', 'pbzip2': '.bz2',
-                           'xz': '.xz', 'unxz': '.xz',
-                           'zstd': '.zst', 'unzstd': '.zst', 'pzstd': '.zst'}
-        if compression not in compression_map:
+        if compression not in COMPRESSION_SUFFIXES:
             return False
-        self.compression_suffix = compression_map[compression]
+        self.compression_suffix = COMPRESSION_SUFFIXES[compression]
         return True
 
     def set_include_list(self, path: bytes, orig_include_list: Iterable[bytes]):
+        base = path_components(path)
         for i in orig_include_list:
-            npath = os.path.normpath(i)
-            while os.path.splitdrive(npath)[1]:
-                self.include_list.add(os.path.join(path, npath))
-                npath = os.path.split(npath)[0]
+            node = self.include_tree
+            for component in path_components(i, base):
+                node = node.setdefault(component, {})
+
+    def included_children(self, path: bytes) -> Iterable[bytes]:
+        """
+        Names under path that are included or have included descendants; empty if everything under path is included
+        """
+        node = self.include_tree
+        for component in path_components(path):
+            node = node.get(component)
+            if not node:
+                return ()
+        return node.keys()
 
     def set_exclude_list(self, path: bytes, orig_exclude_list: Iterable[bytes]):
+        base = path_components(path)
         for i in orig_exclude_list:
-            self.exclude_list.add(os.path.join(path, os.path.normpath(i)))
+            *parents, name = path_components(i, base) or [b'']
+            node = self.exclude_tree
+            for component in parents:
+                node = node.setdefault(component, {})
+                if node is None:
+                    # an ancestor is already excluded
+                    break
+            else:
+                node[name] = None
+
+    def excluded_children(self, path: bytes) -> Iterable[bytes]:
+        """
+        Names under path that are excluded
+        """
+        node = self.exclude_tree
+        for component in path_components(path):
+            node = node.get(component)
+            if not node:
+                return ()
+        return [name for name, child in node.items() if child is None]
 
 
 class DownloadConfig(SyncConfig):
-    pass
+    __slots__ = ()
+
+    def tarball_compression(self, tarball_name: str) -> Optional[str]:
+        """
+        The decompression program of an uploaded tarball; with compression 'auto', chosen by its suffix, since
+          tarballs uploaded by different runs can use different compressions
+        Raises ValueError if the suffix is unknown
+        """
+        if self.compression != 'auto':
+            return self.compression
+        suffix = tarball_suffix(tarball_name)
+        if suffix not in SUFFIX_COMPRESSIONS:
+            raise ValueError(f'Unknown compression of {tarball_name}; please specify it with -I')
+        return SUFFIX_COMPRESSIONS[suffix]
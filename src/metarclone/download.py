@@ -1,84 +1,175 @@
 import logging
 import os
-import posixpath
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
 
 from .config import DownloadConfig
 from .metadata import load_metadata
-from .utils import decode_child
+from .utils import decode_child, clear_child_caches, join_path, join_remote
 from .rclone import rclone_download
 
 
+# Hard links are restored relative to an open directory where supported, which saves resolving the full path
+USE_DIR_FD = {os.unlink, os.link} <= os.supports_dir_fd and os.utime in os.supports_fd
+O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0)
+
+
 class DownloadWalkResult:
+    __slots__ = ('real_transfer_size', 'real_transfer_files', 'error_count')
+
     def __init__(self):
         self.real_transfer_size = 0
         self.real_transfer_files = 0
         self.error_count: int = 0
 
+    def merge(self, other: 'DownloadWalkResult'):
+        self.real_transfer_size += other.real_transfer_size
+        self.real_transfer_files += other.real_transfer_files
+        self.error_count += other.error_count
 
-def download_walk(path: bytes, remote_path: str, metadata: dict, conf: DownloadConfig) -> DownloadWalkResult:
-    res = DownloadWalkResult()
-    try:
-        os.makedirs(path, exist_ok=True)
-    except OSError as e:
-        logging.warning(f'Error creating {repr(path)[1:]}: {e}')
-        res.error_count += 1
-        return res
-
-    if not conf.dest_as_empty:
-        # TODO: checksum
-        raise NotImplementedError()
 
-    for child in metadata['files']:
-        nbytes = rclone_download(posixpath.join(remote_path, child), path, conf)
+def download_files(path: bytes, remote_path: str, files: List[str], conf: DownloadConfig) -> DownloadWalkResult:
+    res = DownloadWalkResult()
+    # tarballs uploaded by different runs may use different compressions; see DownloadConfig.tarball_compression
+    groups: Dict[Optional[str], List[str]] = {}
+    for i in files:
+        try:
+            groups.setdefault(conf.tarball_compression(i), []).append(i)
+        except ValueError as e:
+            logging.warning(f'Error downloading {join_remote(remote_path, i)}: {e}')
+            res.error_count += 1
+    for compression, group in groups.items():
+        if len(group) == 1:
+            nbytes = rclone_download(join_remote(remote_path, group[0]), path, compression, conf)
+        else:
+            # fetch and extract all tarballs of this directory in one pipeline
+            nbytes = rclone_download(remote_path, path, compression, conf, group)
         if nbytes < 0:
-            logging.warning(f'Error downloading f{posixpath.join(remote_path, child)}')
+            logging.warning(f'Error downloading {", ".join(join_remote(remote_path, i) for i in group)}')
             res.error_count += 1
         else:
-            res.real_transfer_files += 1
+            res.real_transfer_files += len(group)
             res.real_transfer_size += nbytes
+    return res
+
+
+def download_walk(path: bytes, remote_path: str, metadata: dict, conf: DownloadConfig,
+                  pool: Executor, futures: List[Future]) -> DownloadWalkResult:
+    """
+    Create the directory tree and submit the download of each directory's tarballs to pool
+    The tarballs of different directories contain disjoint files, so they can be extracted concurrently; the results
+      of the downloads are appended to futures
+    Directories are visited breadth-first with an explicit queue, so deep trees do not hit the recursion limit and the
+      downloads of shallow directories are submitted first
+    """
+    error_count = 0
+    queue = deque([(path, remote_path, metadata)])
+    while queue:
+        path, remote_path, metadata = queue.popleft()
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            logging.warning(f'Error creating {repr(path)[1:]}: {e}')
+            error_count += 1
+            continue
 
-    for child, child_meta in metadata['children'].items():
-        child_res = download_walk(os.path.join(path, decode_child(child)), posixpath.join(remote_path, child),
-                                  child_meta, conf)
-        res.real_transfer_files += child_res.real_transfer_files
-        res.real_transfer_size += child_res.real_transfer_size
-        res.error_count += child_res.error_count
+        if not conf.dest_as_empty:
+            # TODO: checksum
+            raise NotImplementedError()
+
+        files = list(metadata['files'])
+        if files:
+            futures.append(pool.submit(download_files, path, remote_path, files, conf))
+
+        queue.extend((join_path(path, decode_child(child)), join_remote(remote_path, child), child_meta)
+                     for child, child_meta in metadata['children'].items())
+    res = DownloadWalkResult()
+    res.error_count = error_count
     return res
 
 
+def restore_hard_links(path: bytes, hard_links: List[dict]) -> int:
+    """
+    Replace the extracted copies of hard-linked files with links to the first file of their group
+    Returns the number of errors
+    Each parent directory is opened and stat'ed once, and its mtime is restored once after all its links are made
+    """
+    error_count = 0
+    # directory -> (file descriptor or None if dir_fd is unsupported or the directory is unreadable,
+    #               stat before modification)
+    dirs: Dict[bytes, Tuple[Optional[int], os.stat_result]] = {}
+    try:
+        for item in hard_links:
+            group = list(map(decode_child, item['group']))
+            link_src = join_path(path, group[0])
+            for i in group[1:]:
+                fpath = join_path(path, i)
+                fdir, fname = os.path.split(fpath)
+                try:
+                    if fdir not in dirs:
+                        dir_stat = os.stat(fdir)
+                        dir_fd = None
+                        if USE_DIR_FD:
+                            try:
+                                dir_fd = os.open(fdir, os.O_RDONLY | O_DIRECTORY)
+                            except OSError:
+                                # the directory may be write-only (e.g. mode 0300); fall back to path-based operations
+                                pass
+                        dirs[fdir] = dir_fd, dir_stat
+                    fd = dirs[fdir][0]
+                    if fd is None:
+                        os.remove(fpath)
+                        os.link(link_src, fpath)
+                    else:
+                        os.unlink(fname, dir_fd=fd)
+                        os.link(link_src, fname, dst_dir_fd=fd)
+                except OSError as e:
+                    # TODO: The current hard link restoration would fail if the owner or permission settings prevents
+                    #  the file from being deleted (the owner & permission has been set by tar extraction). The correct
+                    #  way would be temporarily change the owner and permission to allow the operation, and restore
+                    #  them after the hard link is set up.
+                    logging.warning(f'Error restoring hardlink on {repr(fpath)[1:]}: {e}')
+                    error_count += 1
+    finally:
+        for fdir, (fd, dir_stat) in dirs.items():
+            try:
+                os.utime(fdir if fd is None else fd, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+            except OSError as e:
+                logging.warning(f'Error restoring mtime of {repr(fdir)[1:]}: {e}')
+                error_count += 1
+            finally:
+                if fd is not None:
+                    os.close(fd)
+    return error_count
+
+
 def download_meta(path: bytes, remote_path: str, metadata: dict, conf: DownloadConfig) -> DownloadWalkResult:
     meta_checksum = metadata['checksum']
     conf.use_file_checksum = meta_checksum['use_file_checksum']
     conf.use_directory_mtime = meta_checksum['use_directory_mtime']
     conf.use_owner = meta_checksum['use_owner']
-    conf.set_hash_function(meta_checksum['hash_function'])
+    # download never hashes anything, so only record the name; resolving the constructor would fail if the upload
+    #   used an optional backend (e.g. blake3) that is not installed here
+    conf.hash_name = meta_checksum['hash_function']
+    try:
+        root_compression = conf.tarball_compression(metadata['root_name'])
+    except ValueError as e:
+        logging.fatal(f'FATAL: {e}')
+        raise RuntimeError('Unknown compression') from None
 
-    res = download_walk(path, remote_path, metadata['meta'], conf)
+    futures: List[Future] = []
+    with ThreadPoolExecutor(max_workers=conf.transfer_threads, thread_name_prefix='download') as pool:
+        res = download_walk(path, remote_path, metadata['meta'], conf, pool, futures)
+        for future in as_completed(futures):
+            res.merge(future.result())
 
-    # Restore hard links
-    for item in metadata['hard_links']:
-        group = list(map(decode_child, item['group']))
-        link_src = os.path.join(path, group[0])
-        for i in group[1:]:
-            fpath = os.path.join(path, i)
-            fdir = os.path.split(fpath)[0]
-            try:
-                dir_stat = os.stat(fdir)
-                os.remove(os.path.join(path, i))
-                os.link(link_src, fpath)
-                os.utime(fdir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
-            except OSError as e:
-                # TODO: The current hard link restoration would fail if the owner or permission settings prevents the
-                #  file from being deleted (the owner & permission has been set by tar extraction). The correct way
-                #  would be temporarily change the owner and permission to allow the operation, and restore them after
-                #  the hard link is set up.
-                logging.warning(f'Error restoring hardlink on {repr(fpath)[1:]}: {e}')
-                res.error_count += 1
-
-    root_file = posixpath.join(remote_path, metadata['root_name'])
-    nbytes = rclone_download(root_file, path, conf)
+    res.error_count += restore_hard_links(path, metadata['hard_links'])
+
+    root_file = join_remote(remote_path, metadata['root_name'])
+    nbytes = rclone_download(root_file, path, root_compression, conf)
     if nbytes < 0:
-        logging.warning(f'Error downloading f{root_file}')
+        logging.warning(f'Error downloading {root_file}')
         res.error_count += 1
     else:
         res.real_transfer_files += 1
@@ -91,4 +182,6 @@ def download(path: bytes, remote_path: str, conf: DownloadConfig) -> DownloadWal
     if metadata is None:
         logging.fatal('FATAL: Cannot load metadata.')
         raise RuntimeError('Metadata reading failed')
-    return download_meta(path, remote_path, metadata, conf)
+    res = download_meta(path, remote_path, metadata, conf)
+    clear_child_caches()
+    return res
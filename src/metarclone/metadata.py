@@ -1,5 +1,6 @@
 import base64
-import io
+import functools
+import gzip
 import json
 import logging
 import posixpath
@@ -7,12 +8,31 @@ import sys
 from gzip import GzipFile
 from io import BytesIO
 from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Iterator, Optional
 
 from .config import SyncConfig
-from .rclone import rclone_upload_raw, rclone_download_raw
+from .rclone import rclone_upload_stream, rclone_download_raw
 
-# Always use gzip for metadata compression to avoid complicated rclone piping
-__all__ = ['load_metadata', 'save_metadata']
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    # optional; several times faster than json for both encoding and decoding
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ['load_metadata', 'save_metadata', 'metadata_uses_zstd', 'HAS_ZSTD']
+
+# Metadata is compressed with gzip, or with zstd if the metadata path is explicitly given with a .zst suffix
+#   (which needs the zstandard package); the default name is always .json.gz
+# Metadata is mostly base32 names and checksums; higher levels are much slower for little gain
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+WRITE_CHUNK_SIZE = 256 * 1024
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+HAS_ZSTD = zstandard is not None
 
 
 def metadata_path(remote_path: str, conf: SyncConfig):
@@ -23,53 +43,119 @@ def metadata_path(remote_path: str, conf: SyncConfig):
                conf.metadata_path
 
 
+def metadata_uses_zstd(path: str) -> bool:
+    return path.endswith('.zst')
+
+
+def parse_metadata(data: bytes) -> Optional[dict]:
+    # the compression is detected from the content, so metadata written with either compression can be read
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            logging.fatal('FATAL: The metadata is compressed with zstd; install the zstandard package to read it')
+            raise RuntimeError('zstandard is required to read the metadata')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    try:
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+    except json.JSONDecodeError:
+        # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+        return None
+
+
 def load_metadata(remote_path: str, conf: SyncConfig):
     is_remote, path = metadata_path(remote_path, conf)
     if is_remote:
         data = rclone_download_raw(path, conf)
         if data is None:
             return None
-        with BytesIO(data) as stream, GzipFile(mode='rb', fileobj=stream) as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return None
     else:
         try:
-            with open(path, 'rb') as stream, GzipFile(mode='rb', fileobj=stream) as f:
-                return json.load(f)
+            with open(path, 'rb') as f:
+                data = f.read()
         except FileNotFoundError:
             return None
+    return parse_metadata(data)
+
+
+def json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+
+
+def encode_tree(node: dict) -> Iterator[bytes]:
+    """
+    JSON encoding of a directory node of the metadata ({'files': ..., 'children': ...}), in one piece per directory
+    """
+    yield b'{'
+    for i, (key, value) in enumerate(node.items()):
+        yield (b',' if i else b'') + json_dumps(key) + b':'
+        if key == 'children':
+            yield b'{'
+            for j, (name, child) in enumerate(value.items()):
+                yield (b',' if j else b'') + json_dumps(name) + b':'
+                yield from encode_tree(child)
+            yield b'}'
+        else:
+            yield json_dumps(value)
+    yield b'}'
+
+
+def encode_metadata(metadata: dict) -> Iterator[bytes]:
+    yield b'{'
+    for i, (key, value) in enumerate(metadata.items()):
+        yield (b',' if i else b'') + json_dumps(key) + b':'
+        if key == 'meta':
+            yield from encode_tree(value)
+        else:
+            yield json_dumps(value)
+    yield b'}'
+
+
+def write_metadata(metadata: dict, stream: BinaryIO, use_zstd: bool):
+    # Encoded one directory at a time and compressed incrementally, so neither the whole JSON nor the whole
+    #   compressed file is held in memory
+    if use_zstd:
+        f = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(stream, closefd=False)
+    else:
+        f = GzipFile(mode='wb', fileobj=stream, compresslevel=GZIP_LEVEL)
+    with f:
+        buf = bytearray()
+        for chunk in encode_metadata(metadata):
+            buf += chunk
+            # the pieces are small; write them to the compressor in larger blocks
+            if len(buf) >= WRITE_CHUNK_SIZE:
+                f.write(buf)
+                buf.clear()
+        f.write(buf)
 
 
 def save_metadata(metadata: dict, remote_path: str, conf: SyncConfig):
     if conf.dry_run:
         return
-    with BytesIO() as stream:
-        with GzipFile(mode='wb', fileobj=stream) as f:
-            with io.TextIOWrapper(f) as ftext:
-                json.dump(metadata, ftext)
-        data = stream.getvalue()
     is_remote, path = metadata_path(remote_path, conf)
+    use_zstd = metadata_uses_zstd(path)
     if is_remote:
-        if rclone_upload_raw(path, data, conf):
+        if rclone_upload_stream(path, functools.partial(write_metadata, metadata, use_zstd=use_zstd), conf):
             return
     else:
         try:
             with open(path, 'wb') as f:
-                f.write(data)
+                write_metadata(metadata, f, use_zstd)
             return
         except OSError as e:
             logging.warning(f'Cannot open metadata file {path} for writing: {e.strerror}')
     try:
-        with NamedTemporaryFile(delete=False) as f:
+        with NamedTemporaryFile(delete=False, suffix='.json.zst' if use_zstd else '.json.gz') as f:
             logging.warning(f'Writing to metadata file failed. Trying to write to {f.name} instead...\n')
-            f.write(data)
+            write_metadata(metadata, f, use_zstd)
         logging.warning(
             'Success! Please store the metadata file properly and specify metadata file in subsequent runs. '
             'Otherwise, downloading would fail and uploading will upload the whole directory again.')
     except OSError as e:
-        sys.stderr.write(base64.b64decode(data).decode())
+        with BytesIO() as stream:
+            write_metadata(metadata, stream, use_zstd)
+            with stream.getbuffer() as data:
+                sys.stderr.write(base64.b64encode(data).decode())
         logging.fatal('FATAL: Metadata writing failed. Copy the base64-encoded version of metadata '
                       'and store it to a file manually')
         raise e from None
@@ -1,18 +1,48 @@
+import atexit
+import base64
+import json
 import logging
 import os
+import secrets
+import selectors
+import socket
+import sys
 import tempfile
 import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
 from io import RawIOBase
-from typing import List, Optional
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
 from subprocess import run, Popen, PIPE, DEVNULL
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from .config import SyncConfig, UploadConfig
-from .utils import win_to_posix
+from .utils import win_to_posix, thread_buffer
 
-__all__ = ['rclone_upload', 'rclone_download', 'rclone_upload_raw', 'rclone_download_raw', 'rclone_delete']
+__all__ = ['rclone_upload', 'rclone_download', 'rclone_upload_raw', 'rclone_upload_stream', 'rclone_download_raw',
+           'rclone_delete', 'rclone_delete_files', 'split_remote']
 
-BUF_SIZE = 256 * 1024
-# TODO: deal with KeyboardInterrupt! (currently it just deadlocks waiting for read_thread)
+BUF_SIZE = 1 << 20
+# Pipes between rclone and tar are enlarged to this size (the default /proc/sys/fs/pipe-max-size) where possible
+PIPE_SIZE = 1 << 20
+# fcntl.F_SETPIPE_SZ is only exposed by Python 3.10+; the value is the same on all Linux architectures
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031) if fcntl is not None and sys.platform.startswith('linux') else None
+# os.splice is only available on Linux with Python 3.10+
+HAS_SPLICE = hasattr(os, 'splice')
+# Windows cannot select on pipes, so it copies them with helper threads instead
+USE_SELECTOR = os.name != 'nt'
+HAS_MEMFD = hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd')
+# seconds to wait for `rclone rcd` to accept requests
+RCD_START_TIMEOUT = 30
+RCD_USER = 'metarclone'
+# interval for polling helper threads; a join without timeout cannot be interrupted by KeyboardInterrupt on Windows
+JOIN_INTERVAL = 0.2
 
 
 def read_thread(f, res: List[bytes] = None):
@@ -22,14 +52,267 @@ def read_thread(f, res: List[bytes] = None):
         res.append(f.read())
 
 
-def rclone_upload(path: bytes, files: List[bytes], dest: str, conf: UploadConfig, suggested_size: int = 0) -> int:
-    if conf.dry_run:
-        return 0
+def start_read_threads(*files) -> Tuple[List[threading.Thread], List[List[bytes]]]:
+    """
+    Read each of files to the end in a daemon thread; returns the threads and the lists receiving the contents
+    """
+    results = [[] for _ in files]
+    threads = [threading.Thread(target=read_thread, args=(f, res), daemon=True) for f, res in zip(files, results)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def join_threads(threads: List[threading.Thread]):
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(JOIN_INTERVAL)
+
+
+def grow_pipes(*files):
+    """
+    Enlarge the kernel buffers of pipes, so that the processes on both sides switch less often
+    """
+    if F_SETPIPE_SZ is None:
+        return
+    for f in files:
+        try:
+            fcntl.fcntl(f.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            # above the pipe size limit of an unprivileged user; keep the default size
+            pass
+
+
+def pipe_copy(fp: RawIOBase, out: RawIOBase) -> int:
+    """
+    Copy everything from pipe fp to pipe out; returns the number of bytes copied
+    """
+    if HAS_SPLICE:
+        # moves the data between the pipe buffers in the kernel, without copying it through Python
+        fd_in, fd_out = fp.fileno(), out.fileno()
+        total_bytes = 0
+        for n in iter(lambda: os.splice(fd_in, fd_out, BUF_SIZE), 0):
+            total_bytes += n
+        return total_bytes
+    buffer = thread_buffer(BUF_SIZE)
+    total_bytes = 0
+    for n in iter(lambda: fp.readinto(buffer), 0):
+        out.write(buffer[:n])
+        total_bytes += n
+    return total_bytes
+
+
+def pump_pipes(src: RawIOBase, dst: RawIOBase, errs: Tuple[RawIOBase, ...]) -> Tuple[int, List[bytes]]:
+    """
+    Copy everything from pipe src to pipe dst while draining the pipes in errs, all in this thread with a selector
+    dst is closed when src reaches EOF or the copy fails; returns the number of bytes copied and the contents of errs
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    err_bufs = {f.fileno(): bytearray() for f in errs}
+    for fd in (src_fd, dst_fd, *err_bufs):
+        os.set_blocking(fd, False)
+    total_bytes = 0
+    pending = memoryview(b'')
+    with selectors.DefaultSelector() as sel:
+        for fd in err_bufs:
+            sel.register(fd, selectors.EVENT_READ)
+        sel.register(src_fd, selectors.EVENT_READ)
+        while sel.get_map():
+            for key, _ in sel.select():
+                fd = key.fd
+                if fd in err_bufs:
+                    data = os.read(fd, BUF_SIZE)
+                    if data:
+                        err_bufs[fd] += data
+                    else:
+                        sel.unregister(fd)
+                    continue
+                try:
+                    if fd == src_fd:
+                        if HAS_SPLICE:
+                            # moves the data between the pipe buffers in the kernel
+                            n = os.splice(src_fd, dst_fd, BUF_SIZE)
+                        else:
+                            data = os.read(src_fd, BUF_SIZE)
+                            n = len(data)
+                            pending = memoryview(data)
+                        if not n:
+                            sel.unregister(src_fd)
+                            dst.close()
+                            continue
+                        total_bytes += n
+                        if pending:
+                            sel.unregister(src_fd)
+                            sel.register(dst_fd, selectors.EVENT_WRITE)
+                    else:
+                        if pending:
+                            pending = pending[os.write(dst_fd, pending):]
+                        if not pending:
+                            sel.unregister(dst_fd)
+                            sel.register(src_fd, selectors.EVENT_READ)
+                except BlockingIOError:
+                    if fd == src_fd and HAS_SPLICE:
+                        # src has data, so dst is full; wait until it is writable
+                        sel.unregister(src_fd)
+                        sel.register(dst_fd, selectors.EVENT_WRITE)
+                except OSError:
+                    # one side exited early (e.g. EPIPE); stop copying and let the exit status report it
+                    #   closing src makes the producer fail as well instead of blocking on a full pipe
+                    sel.unregister(fd)
+                    src.close()
+                    dst.close()
+    dst.close()
+    return total_bytes, [bytes(i) for i in err_bufs.values()]
+
+
+def run_pipeline(producer: Popen, consumer: Popen) -> Tuple[int, bytes, bytes]:
+    """
+    Copy the stdout of producer to the stdin of consumer and wait for both of them to exit
+    Returns the number of bytes copied and the stderr outputs of producer and consumer
+    """
+    grow_pipes(producer.stdout, consumer.stdin)
+    try:
+        if USE_SELECTOR:
+            # no helper threads; this also lets KeyboardInterrupt through instead of deadlocking on a join
+            with producer.stdout, producer.stderr, consumer.stderr:
+                total_bytes, (producer_err, consumer_err) = pump_pipes(
+                    producer.stdout, consumer.stdin, (producer.stderr, consumer.stderr))
+        else:
+            # Windows cannot select on pipes
+            threads, (producer_errs, consumer_errs) = start_read_threads(producer.stderr, consumer.stderr)
+            total_bytes = 0
+            try:
+                with producer.stdout as fp, consumer.stdin as out:
+                    total_bytes = pipe_copy(fp, out)
+            except OSError:
+                pass
+            join_threads(threads)
+            producer_err, consumer_err = producer_errs[0], consumer_errs[0]
+        producer.wait()
+        consumer.wait()
+    except BaseException:
+        # do not leave the processes running if we are interrupted
+        producer.kill()
+        consumer.kill()
+        raise
+    return total_bytes, producer_err, consumer_err
+
+
+@contextmanager
+def list_file(content: bytes) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+    """
+    Provide content as a file for -T / --files-from options of a child process
+    Yields the path to pass to the child, and the file descriptors the child must inherit (pass_fds of Popen)
+    On Linux, the content is kept in a memfd opened by the child through /proc/self/fd, so nothing is written to disk
+      and nothing is left behind if we crash; elsewhere a temporary file is used
+    """
+    fd = None
+    if HAS_MEMFD:
+        try:
+            fd = os.memfd_create('metarclone-list')
+        except OSError:
+            pass
+    if fd is not None:
+        try:
+            with open(fd, 'wb', closefd=False) as f:
+                f.write(content)
+            yield f'/proc/self/fd/{fd}', (fd,)
+        finally:
+            os.close(fd)
+        return
     with tempfile.NamedTemporaryFile('wb', delete=False) as f:
         fname = f.name
-        f.write(b'\0'.join(files))
-        f.write(b'\0')
+        f.write(content)
     try:
+        yield fname, ()
+    finally:
+        os.remove(fname)
+
+
+class RcloneDaemon:
+    """
+    A long-lived `rclone rcd` process serving remote operations over its HTTP API, so that they do not start a new
+      rclone (reading the config and authenticating to the remote) for every call
+    It listens on a random loopback port and is protected by a random password
+    """
+
+    def __init__(self, conf: SyncConfig):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        password = secrets.token_urlsafe(24)
+        self.url = f'http://127.0.0.1:{port}/'
+        self.auth = 'Basic ' + base64.b64encode(f'{RCD_USER}:{password}'.encode()).decode()
+        rclone_cmd = [conf.rclone_command, 'rcd', *conf.rclone_args, f'--rc-addr=127.0.0.1:{port}',
+                      f'--rc-user={RCD_USER}']
+        logging.debug(f'Invoke command: {rclone_cmd}')
+        # passed by environment so that the password does not show up in the process list
+        env = dict(os.environ, RCLONE_RC_PASS=password)
+        self.proc = Popen(rclone_cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, env=env)
+        deadline = time.monotonic() + RCD_START_TIMEOUT
+        while True:
+            try:
+                self.call('rc/noop')
+                break
+            except OSError:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise OSError(f'rclone rcd failed to start (status {self.proc.returncode})') from None
+                time.sleep(0.05)
+
+    def call(self, method: str, **params) -> dict:
+        """
+        Invoke an rc method; raises OSError with rclone's error message on failure
+        """
+        request = urllib.request.Request(self.url + method, data=json.dumps(params).encode(), method='POST',
+                                         headers={'Content-Type': 'application/json', 'Authorization': self.auth})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise OSError(f'{method} failed with HTTP status {e.code}: {message}') from None
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+
+_rcd: Optional[RcloneDaemon] = None
+_rcd_lock = threading.Lock()
+
+
+def get_rcd(conf: SyncConfig) -> RcloneDaemon:
+    """
+    The rclone rcd of this process, started on first use and stopped at exit
+    """
+    global _rcd
+    with _rcd_lock:
+        if _rcd is None:
+            _rcd = RcloneDaemon(conf)
+            atexit.register(_rcd.close)
+        return _rcd
+
+
+def split_remote(path: str) -> Tuple[str, str]:
+    """
+    Split a remote path into the fs and remote parameters of rc operations
+    """
+    parent, sep, name = path.rpartition('/')
+    if sep:
+        return parent + sep, name
+    remote, sep, name = path.rpartition(':')
+    return (remote + sep if sep else '.'), name
+
+
+def rclone_upload(path: bytes, files: List[bytes], dest: str, conf: UploadConfig, suggested_size: int = 0) -> int:
+    if conf.dry_run:
+        return 0
+    with list_file(b'\0'.join(files) + b'\0') as (fname, pass_fds):
         tar_cmd = [conf.tar_command.encode()]
         if conf.compression:
             tar_cmd += [b'-I', conf.compression.encode()]
@@ -43,83 +326,60 @@ def rclone_upload(path: bytes, files: List[bytes], dest: str, conf: UploadConfig
             rclone_cmd.append(f'--s3-chunk-size={s3_block_size_kib}')
         elif conf.s3_min_chunk_size_kib > 5 * 1024:
             rclone_cmd.append(f'--s3-chunk-size={conf.s3_min_chunk_size_kib}')
-        rclone_cmd += [*conf.rclone_args, dest]
+        rclone_cmd += [*conf.rclone_args, *conf.rclone_upload_args, dest]
         logging.debug(f'Invoke command: {tar_cmd}')
-        tar_proc = Popen(tar_cmd, stdout=PIPE, stderr=PIPE)
+        tar_proc = Popen(tar_cmd, stdout=PIPE, stderr=PIPE, pass_fds=pass_fds)
         logging.debug(f'Invoke command: {rclone_cmd}')
         rclone_proc = Popen(rclone_cmd, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
 
-        buffer = memoryview(bytearray(BUF_SIZE))
-        stderr = []
-        tarerr = []
-        threrr = threading.Thread(target=read_thread, args=(rclone_proc.stderr, stderr))
-        thrtarerr = threading.Thread(target=read_thread, args=(tar_proc.stderr, tarerr))
-        threrr.start()
-        thrtarerr.start()
-        try:
-            with tar_proc.stdout as fp, rclone_proc.stdin as out:
-                fp: RawIOBase
-                out: RawIOBase
-                total_bytes = 0
-                for n in iter(lambda: fp.readinto(buffer), 0):
-                    out.write(buffer[:n])
-                    total_bytes += n
-        except OSError:
-            pass
-        threrr.join()
-        thrtarerr.join()
-        status = tar_proc.wait(), rclone_proc.wait()
-        if status[1]:
-            logging.warning(f'rclone rcat failed with status {status[1]}: {stderr[0]}')
+        total_bytes, tarerr, stderr = run_pipeline(tar_proc, rclone_proc)
+        if rclone_proc.returncode:
+            logging.warning(f'rclone rcat failed with status {rclone_proc.returncode}: {stderr}')
             return -1
-        if status[0]:
-            logging.warning(f'tar failed with status {status[1]}: {tarerr[0]}')
+        if tar_proc.returncode:
+            logging.warning(f'tar failed with status {tar_proc.returncode}: {tarerr}')
             return -1
         return total_bytes
-    finally:
-        os.remove(fname)
 
 
-def rclone_download(path: str, dest: bytes, conf: SyncConfig) -> int:
+def rclone_download(path: str, dest: bytes, compression: Optional[str], conf: SyncConfig,
+                    files: Optional[List[str]] = None) -> int:
+    """
+    Download and extract the tarball at path into dest, decompressing it with compression (passed to tar's -I option)
+    If files is given, path is a remote directory, and all tarballs in files under it are streamed by a single rclone
+      and extracted by a single tar, which avoids spawning a pair of processes and a remote session for each file
+    """
     if conf.dry_run:
         return 0
     if os.name == 'nt':
         dest = win_to_posix(dest)
-    rclone_cmd = [conf.rclone_command, 'cat', *conf.rclone_args, path]
+    rclone_cmd = [conf.rclone_command, 'cat', *conf.rclone_args]
     tar_cmd = [conf.tar_command.encode()]
-    if conf.compression:
-        tar_cmd += [b'-I', conf.compression.encode()]
+    if compression:
+        tar_cmd += [b'-I', compression.encode()]
+    if files is not None:
+        # the concatenated stream contains an end-of-archive marker after each tarball
+        tar_cmd.append(b'--ignore-zeros')
     tar_cmd += [b'-C', dest, b'-Sxf', b'-']
+    if files is None:
+        return rclone_cat_to_tar([*rclone_cmd, path], tar_cmd)
+    # tarball names only contain [A-Za-z0-9_.]
+    with list_file(''.join(i + '\n' for i in files).encode()) as (fname, pass_fds):
+        return rclone_cat_to_tar([*rclone_cmd, '--files-from-raw', fname, path], tar_cmd, pass_fds)
+
+
+def rclone_cat_to_tar(rclone_cmd: list, tar_cmd: list, pass_fds: Tuple[int, ...] = ()) -> int:
     logging.debug(f'Invoke command: {rclone_cmd}')
-    rclone_proc = Popen(rclone_cmd, stdout=PIPE, stderr=PIPE)
+    rclone_proc = Popen(rclone_cmd, stdout=PIPE, stderr=PIPE, pass_fds=pass_fds)
     logging.debug(f'Invoke command: {tar_cmd}')
     tar_proc = Popen(tar_cmd, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
 
-    buffer = memoryview(bytearray(BUF_SIZE))
-    stderr = []
-    tarerr = []
-    threrr = threading.Thread(target=read_thread, args=(rclone_proc.stderr, stderr))
-    thrtarerr = threading.Thread(target=read_thread, args=(tar_proc.stderr, tarerr))
-    threrr.start()
-    thrtarerr.start()
-    try:
-        with rclone_proc.stdout as fp, tar_proc.stdin as out:
-            fp: RawIOBase
-            out: RawIOBase
-            total_bytes = 0
-            for n in iter(lambda: fp.readinto(buffer), 0):
-                out.write(buffer[:n])
-                total_bytes += n
-    except OSError:
-        pass
-    threrr.join()
-    thrtarerr.join()
-    status = tar_proc.wait(), rclone_proc.wait()
-    if status[1]:
-        logging.warning(f'rclone cat failed with status {status[1]}: {stderr[0]}')
+    total_bytes, stderr, tarerr = run_pipeline(rclone_proc, tar_proc)
+    if rclone_proc.returncode:
+        logging.warning(f'rclone cat failed with status {rclone_proc.returncode}: {stderr}')
         return -1
-    if status[0]:
-        logging.warning(f'tar failed with status {status[1]}: {tarerr[0]}')
+    if tar_proc.returncode:
+        logging.warning(f'tar failed with status {tar_proc.returncode}: {tarerr}')
         return -1
     return total_bytes
 
@@ -136,6 +396,34 @@ def rclone_upload_raw(dest: str, content: bytes, conf: SyncConfig) -> bool:
     return True
 
 
+def rclone_upload_stream(dest: str, write: Callable[[BinaryIO], None], conf: SyncConfig) -> bool:
+    """
+    Like rclone_upload_raw, but the content is written to rclone's stdin by write instead of being passed as bytes
+    """
+    if conf.dry_run:
+        return True
+    rclone_cmd = [conf.rclone_command, 'rcat', *conf.rclone_args, dest]
+    logging.debug(f'Invoke command: {rclone_cmd}')
+    rclone_proc = Popen(rclone_cmd, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+    try:
+        threads, (stderr,) = start_read_threads(rclone_proc.stderr)
+        try:
+            with rclone_proc.stdin as out:
+                write(out)
+        except OSError:
+            # rclone exited early; reported by its status below
+            pass
+        join_threads(threads)
+        status = rclone_proc.wait()
+    except BaseException:
+        rclone_proc.kill()
+        raise
+    if status:
+        logging.warning(f'rclone rcat failed with status {status}: {stderr[0]}')
+        return False
+    return True
+
+
 def rclone_download_raw(dest: str, conf: SyncConfig) -> Optional[bytes]:
     # Dry run still needs metadata
     rclone_cmd = [conf.rclone_command, 'cat', *conf.rclone_args, dest]
@@ -150,6 +438,15 @@ def rclone_download_raw(dest: str, conf: SyncConfig) -> Optional[bytes]:
 def rclone_delete(path: str, is_dir: bool, conf: SyncConfig) -> bool:
     if conf.dry_run:
         return True
+    if conf.use_rclone_rcd:
+        method = 'operations/purge' if is_dir else 'operations/deletefile'
+        fs, remote = split_remote(path)
+        try:
+            get_rcd(conf).call(method, fs=fs, remote=remote)
+        except OSError as e:
+            logging.warning(f'rclone {method} on {path} failed: {e}')
+            return False
+        return True
     rclone_cmd = [conf.rclone_command, 'purge' if is_dir else 'delete', *conf.rclone_args, path]
     logging.debug(f'Invoke command: {rclone_cmd}')
     res = run(rclone_cmd, capture_output=True)
@@ -157,3 +454,21 @@ def rclone_delete(path: str, is_dir: bool, conf: SyncConfig) -> bool:
         logging.warning(f'rclone purge failed with status{res.returncode}: {res.stderr}')
         return False
     return True
+
+
+def rclone_delete_files(path: str, names: List[str], conf: SyncConfig) -> bool:
+    """
+    Delete the files names directly under the remote directory path with a single rclone
+    rclone looks the listed files up directly instead of listing the directory
+    """
+    if conf.dry_run:
+        return True
+    # the names are tarballs, which only contain [A-Za-z0-9_.]
+    with list_file(''.join(i + '\n' for i in names).encode()) as (fname, pass_fds):
+        rclone_cmd = [conf.rclone_command, 'delete', *conf.rclone_args, '--files-from-raw', fname, path]
+        logging.debug(f'Invoke command: {rclone_cmd}')
+        res = run(rclone_cmd, capture_output=True, pass_fds=pass_fds)
+    if res.returncode:
+        logging.warning(f'rclone delete failed with status {res.returncode}: {res.stderr}')
+        return False
+    return True
@@ -1,25 +1,53 @@
+import functools
 import logging
 import os
-import posixpath
-import stat
-from typing import Dict, Tuple, Optional, List, Set
-
-from disjoint_set import DisjointSet
-
-from .config import UploadConfig
-from .checksum import init_file_checksum, one_file_checksum, checksum_walk, ChecksumWalkResult
-from .utils import wrap_oserror, decode_child, encode_child
-from .rclone import rclone_upload, rclone_delete
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from stat import S_IFDIR
+from typing import Callable, Dict, Iterable, Iterator, Tuple, Optional, List, Set
+
+from .config import UploadConfig, SUFFIX_COMPRESSIONS, tarball_suffix
+from .checksum import (init_file_checksum, one_file_checksum, one_file_checksums, checksum_walk, checksum_pool,
+                       ChecksumWalkResult, ContentChecksums, S_IFMT_MASK)
+from .utils import wrap_oserror, decode_child, encode_child, clear_child_caches, join_path, join_remote
+from .rclone import rclone_upload, rclone_delete, rclone_delete_files, split_remote
 from .metadata import *
+from .cache import ChecksumCache, load_checksum_cache, save_checksum_cache
+
+# Children are stat'ed relative to an open directory where supported, which saves resolving the full path of each
+USE_DIR_FD = os.stat in os.supports_dir_fd
+O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0)
+# With conf.stat_threads > 1, directories with at least this many children are stat'ed in the thread pool,
+#   STAT_BATCH children per task
+PARALLEL_STAT_MIN_FILES = 64
+STAT_BATCH = 32
 
 
 class UploadState:
     def __init__(self):
         self.hard_link_map: Dict[Tuple[int, int], bytes] = {}
         self.hard_link_list: List[Tuple[bytes, bytes]] = []
+        # remote files to delete after upload, in visiting order; shared by the whole walk instead of being
+        #   concatenated into each parent
+        self.files_to_delete: List[Tuple[str, bool]] = []
+        # local directories whose children are uploaded separately, so they are stored in the root tarball; shared in
+        #   the same way, see UploadWalkResult.set_force_retain
+        self.retained_directories: List[bytes] = []
+        # thread pool for stat'ing children; see stat_children
+        self.stat_pool: Optional[Executor] = None
+        # thread pool for uploading tarballs, and the uploads submitted to it as
+        #   (local directory, upload name, metadata['files'] of the directory, future of rclone_upload)
+        # The uploads are independent, so they are only collected after the walk; see submit_upload
+        self.upload_pool: Optional[Executor] = None
+        self.uploads: List[Tuple[bytes, str, Dict[str, dict], Future]] = []
 
 
 class UploadWalkResult:
+    __slots__ = ('total_size', 'total_files', 'total_transfer_size', 'total_transfer_files', 'total_deleted_files',
+                 'real_transfer_size', 'real_transfer_files', 'force_retain', 'hard_link_map', 'files_to_tar',
+                 'files_to_delete', 'retained_directories', 'metadata', 'first_checksum', 'second_checksum',
+                 'error_count')
+
     def __init__(self):
         # The values of an empty directory
         self.total_size = 0
@@ -34,44 +62,193 @@ class UploadWalkResult:
         # files_to_tar is None -> some child has already tar'd
         # not include the current directory
         self.files_to_tar: Optional[Set[bytes]] = set()
+        # only filled in the result of the walk root; see UploadState.files_to_delete and retained_directories
         self.files_to_delete: List[Tuple[str, bool]] = []
-        self.retained_directories: Optional[List[bytes]] = None
+        self.retained_directories: List[bytes] = []
         self.metadata: Optional[dict] = None
         self.first_checksum: Optional[bytes] = None
         self.second_checksum: Optional[bytes] = None
         self.error_count: int = 0
 
-    def set_force_retain(self, path: bytes):
+    def set_force_retain(self, path: bytes, state: UploadState):
         if not self.force_retain:
             self.force_retain = True
             self.files_to_tar = None
             self.metadata = {'files': {}, 'children': {}}
-            self.retained_directories = [path]
+            state.retained_directories.append(path)
             self.hard_link_map = None
 
 
-def upload_walk(path: bytes, remote_path: str, st: os.stat_result, metadata: Optional[dict], conf: UploadConfig,
-                state: UploadState, is_root: bool) -> Optional[UploadWalkResult]:
+def stat_names(path: bytes, fd: Optional[int], names: Iterable[bytes]) -> List[Tuple[bytes, os.stat_result]]:
     """
-    Metadata format:
-    {
-      "files": { // each represents a remote file
-        "xxx.tar.gz": { // filename, contains only [A-Za-z0-9_.]
-          "list": [b32encode of first-layer dir/files],
-          "file_size_checksum": "...", <if conf.use_file_checksum>
-          "file_checksum": "...", <if conf.use_file_checksum>
-          "mtime_checksum": "...", <if not conf.use_file_checksum>
-        }
-      },
-      "children": {
-        <b32encode of name>: (another metadata), ...
-      },
-    }
+    lstat each of names in directory path, relative to fd if it is not None
+    The children that cannot be stat'ed are logged and left out
+    """
+    res: List[Tuple[bytes, os.stat_result]] = []
+    for child in names:
+        try:
+            if fd is None:
+                res.append((child, os.stat(join_path(path, child), follow_symlinks=False)))
+            else:
+                res.append((child, os.stat(child, dir_fd=fd, follow_symlinks=False)))
+        except OSError as e:
+            logging.warning(f'Error accessing {repr(join_path(path, child))[1:]}: {e}')
+    return res
 
-    Note that we upload each inode once in every tar file it is in, so hard links across different tar files will be
-      uploaded multiple times.
-    It is possible to only upload once for each inode globally, but it requires extra metadata information and passes to
-      check and correctly update changes of the hardlink structure, so currently we do not implement it.
+
+def stat_children(path: bytes, names: Set[bytes], pool: Optional[Executor] = None) -> Dict[bytes, os.stat_result]:
+    """
+    lstat each of names in directory path
+    If pool is given, large directories are stat'ed in batches in the pool, which overlaps the latency of network
+      filesystems and disks
+    """
+    fd: Optional[int] = None
+    if USE_DIR_FD:
+        try:
+            fd = os.open(path, os.O_RDONLY | O_DIRECTORY)
+        except OSError:
+            # stat by full path instead; the errors are reported per child
+            pass
+    try:
+        if pool is None or len(names) < PARALLEL_STAT_MIN_FILES:
+            return dict(stat_names(path, fd, names))
+        names = list(names)
+        batches = [names[i:i + STAT_BATCH] for i in range(0, len(names), STAT_BATCH)]
+        stat_map: Dict[bytes, os.stat_result] = {}
+        for batch in pool.map(functools.partial(stat_names, path, fd), batches):
+            stat_map.update(batch)
+        return stat_map
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+class UploadFrame:
+    """
+    A directory being visited by upload_walk: everything computed before its subdirectories are visited
+    """
+    __slots__ = ('path', 'remote_path', 'st', 'metadata', 'is_root', 'res', 'stat_map', 'child_list', 'remote_names',
+                 'encoded_names', 'dir_result_map', 'size_map', 'err_list', 'subdirs')
+
+    def __init__(self, path: bytes, remote_path: str, st: os.stat_result, metadata: Optional[dict], is_root: bool):
+        self.path = path
+        self.remote_path = remote_path
+        self.st = st
+        self.metadata = metadata
+        self.is_root = is_root
+        self.res = UploadWalkResult()
+        self.stat_map: Dict[bytes, os.stat_result] = {}
+        # all stat'able children
+        self.child_list: Set[bytes] = set()
+        self.remote_names: Set[str] = set()
+        # encode_child of each child in child_list, computed once since a child name is encoded up to three times
+        self.encoded_names: Dict[bytes, str] = {}
+        # all children that needs to be uploaded
+        self.dir_result_map: Dict[bytes, UploadWalkResult] = {}
+        self.size_map: Dict[bytes, int] = {}
+        self.err_list: List[bytes] = []
+        # subdirectories not visited yet
+        self.subdirs: Iterator[bytes] = iter(())
+
+
+def remote_del(frame: UploadFrame, state: UploadState, name: str, is_dir: bool, conf: UploadConfig):
+    res = frame.res
+    del_path = join_remote(frame.remote_path, name)
+    if conf.delete_after_upload:
+        logging.debug(f'Marked {del_path} to delete')
+        state.files_to_delete.append((del_path, is_dir))
+    else:
+        logging.info(f'Deleting remote: {del_path}')
+        if not rclone_delete(del_path, is_dir, conf):
+            logging.warning(f'Failed to delete remote: {del_path}')
+            res.error_count += 1
+        else:
+            res.total_deleted_files += 1
+
+
+def submit_upload(frame: UploadFrame, state: UploadState, files: List[bytes], upload_name: str, dest: str,
+                  suggested_size: int, conf: UploadConfig):
+    """
+    Upload files under frame.path to dest (upload_name in frame.remote_path), in state.upload_pool if there is one
+    Without a pool, the result is accounted to frame.res right away; otherwise see collect_upload
+    """
+    files_meta = frame.res.metadata['files']
+    if state.upload_pool is None:
+        collect_upload(frame.res, frame.path, upload_name, files_meta,
+                       rclone_upload(frame.path, files, dest, conf, suggested_size))
+    else:
+        future = state.upload_pool.submit(rclone_upload, frame.path, files, dest, conf, suggested_size)
+        state.uploads.append((frame.path, upload_name, files_meta, future))
+
+
+def collect_upload(res: UploadWalkResult, path: bytes, upload_name: str, files_meta: Dict[str, dict], nbytes: int):
+    """
+    Account the result of rclone_upload to res, which is the result of the uploaded directory or one of its ancestors
+    """
+    if nbytes < 0:
+        # A extreme edge case may make upload fail: when conf.file_base_bytes is an underestimation so that
+        #   the real upload size is larger than ~50GiB (the S3 limit with the default chunk size) but
+        #   group_size is not, the upload function may fail to use the proper chunk size.
+        # This case needs an infeasibly large number of small files so we do not deal with this yet
+        log_name = repr(join_path(path, upload_name.encode()))[1:]
+        logging.warning(f'Failed to upload: {log_name}')
+        # delete from metadata so later syncs can detect it
+        del files_meta[upload_name]
+        res.error_count += 1
+    else:
+        res.real_transfer_size += nbytes
+        res.real_transfer_files += 1
+
+
+def update_hardlink_map(state: UploadState, key: Tuple[int, int], fpath: bytes,
+                        new_hardlinks: Dict[Tuple[int, int], bytes]):
+    if key in state.hard_link_map:
+        state.hard_link_list.append((state.hard_link_map[key], fpath))
+    else:
+        new_hardlinks[key] = fpath
+
+
+def multifile_checksum(frame: UploadFrame, names: List[bytes], conf: UploadConfig, first_hash, second_hash=None):
+    """
+    names already sorted
+    Update first_hash with the first-pass checksums of names, and second_hash (only given with
+      conf.use_file_checksum) with the second-pass ones; both passes are computed in one loop
+    """
+    path, stat_map, dir_result_map = frame.path, frame.stat_map, frame.dir_result_map
+    full_paths = [join_path(path, ch) for ch in names]
+    contents: Optional[ContentChecksums] = None
+    if second_hash is not None and conf.checksum_threads > 1:
+        # hash the file contents in the thread pool ahead of the serial fold below
+        contents = ContentChecksums(conf, checksum_pool(conf.checksum_threads))
+        contents.prefetch([(full_path, stat_map[ch]) for full_path, ch in zip(full_paths, names)])
+    # The digests are concatenated and hashed with one update per pass, which gives the same result as updating
+    #   per child
+    first_parts: List[bytes] = []
+    second_parts: List[bytes] = []
+    for full_path, ch in zip(full_paths, names):
+        ch_st = stat_map[ch]
+        if ch_st.st_mode & S_IFMT_MASK == S_IFDIR:
+            ch_res = dir_result_map[ch]
+            first_parts.append(ch_res.first_checksum)
+            if second_hash is not None:
+                second_parts.append(ch_res.second_checksum)
+        elif second_hash is None:
+            first_parts.append(one_file_checksum(ch, full_path, ch_st, conf, False))
+        else:
+            first, second = one_file_checksums(ch, full_path, ch_st, conf, contents)
+            first_parts.append(first)
+            second_parts.append(second)
+    first_hash.update(b''.join(first_parts))
+    if second_hash is not None:
+        second_hash.update(b''.join(second_parts))
+
+
+def open_upload_dir(path: bytes, remote_path: str, st: os.stat_result, metadata: Optional[dict], conf: UploadConfig,
+                    state: UploadState, is_root: bool) -> Optional[UploadFrame]:
+    """
+    List and stat a directory, keep the remote files whose checksums are unchanged and account its non-directory
+      children; its subdirectories are left in frame.subdirs for upload_walk to visit
+    return None if the directory cannot be listed
     """
     # noinspection PyUnusedLocal
     dir_list: Optional[Set[bytes]] = None
@@ -80,251 +257,214 @@ def upload_walk(path: bytes, remote_path: str, st: os.stat_result, metadata: Opt
     if dir_list is None:
         return None
     # process include/exclude list
-    includes = set([i for i in dir_list if os.path.join(path, i) in conf.include_list])
+    includes = dir_list.intersection(conf.included_children(path))
     if includes:
         dir_list = includes
-    dir_list = set([i for i in dir_list if os.path.join(path, i) not in conf.exclude_list])
-
-    res = UploadWalkResult()
+    dir_list.difference_update(conf.excluded_children(path))
 
-    def remote_del(name: str, is_dir: bool):
-        del_path = posixpath.join(remote_path, name)
-        if conf.delete_after_upload:
-            logging.debug(f'Marked {del_path} to delete')
-            res.files_to_delete.append((del_path, is_dir))
-        else:
-            logging.info(f'Deleting remote: {del_path}')
-            if not rclone_delete(del_path, is_dir, conf):
-                logging.warning(f'Failed to delete remote: {del_path}')
-                res.error_count += 1
-            else:
-                res.total_deleted_files += 1
-
-    def remote_upload(files: List[bytes], dest: str, suggested_size: int) -> bool:
-        # logging.debug(f'Upload {path}/{files} -> {dest}')
-        nbytes = rclone_upload(path, files, dest, conf, suggested_size)
-        if nbytes < 0:
-            return False
-        res.real_transfer_size += nbytes
-        res.real_transfer_files += 1
-        return True
-
-    def update_hardlink_map(key: Tuple[int, int], fpath: bytes, new_hardlinks: Dict[Tuple[int, int], bytes]):
-        if key in state.hard_link_map:
-            state.hard_link_list.append((state.hard_link_map[key], fpath))
-        else:
-            new_hardlinks[key] = fpath
-
-    stat_map: Dict[bytes, os.stat_result] = {}
-    for child in dir_list:
-        child_path = os.path.join(path, child)
-        with wrap_oserror(child_path):
-            stat_map[child] = os.stat(child_path, follow_symlinks=False)
-    # all stat'able children
-    child_list: Set[bytes] = set(stat_map)
+    frame = UploadFrame(path, remote_path, st, metadata, is_root)
+    res = frame.res
+    frame.stat_map = stat_map = stat_children(path, dir_list, state.stat_pool)
+    frame.child_list = child_list = set(stat_map)
 
     # check metadata
-    remote_names: Set[str] = set()
+    remote_names = frame.remote_names
     if metadata and not conf.dest_as_empty:
+        if conf.use_file_checksum:
+            checksum_keys = ('file_size_checksum', 'file_checksum')
+        else:
+            checksum_keys = ('mtime_checksum',)
         for filename, remote_file in metadata['files'].items():
             filename: str
-            file_list: List[bytes] = [decode_child(i) for i in remote_file['list']]
             keep = False
             walk_res = ChecksumWalkResult()
-            if all([f in stat_map for f in file_list]):
-                # We compute this checksum in a separate run.
-                # This run only affects decision of whether to upload a file, so it does not matter if the files had
-                #   changed between this run and the actual checksum computation for metadata generation.
-                # (Those changes will possibly make some file changed between two runs not uploaded during this sync,
-                #  but it is correctable by later syncs.)
-                walk_list = [(f, stat_map[f]) for f in file_list]
-                if conf.use_file_checksum:
-                    keep = (
-                        'file_size_checksum' in remote_file and
-                        'file_checksum' in remote_file and
-                        checksum_walk(walk_list, path, conf, False, walk_res) == remote_file['file_size_checksum'] and
-                        checksum_walk(walk_list, path, conf, True) == remote_file['file_checksum']
-                    )
-                else:
-                    keep = ('mtime_checksum' in remote_file and
-                            checksum_walk(walk_list, path, conf, False, walk_res) == remote_file['mtime_checksum'])
+            # the cheap checks go first: the checksums are recorded and all the files still exist
+            if all(map(remote_file.__contains__, checksum_keys)):
+                file_set: Set[bytes] = set(map(decode_child, remote_file['list']))
+                if stat_map.keys() >= file_set:
+                    # We compute this checksum in a separate run.
+                    # This run only affects decision of whether to upload a file, so it does not matter if the files
+                    #   had changed between this run and the actual checksum computation for metadata generation.
+                    # (Those changes will possibly make some file changed between two runs not uploaded during this
+                    #  sync, but it is correctable by later syncs.)
+                    walk_list = [(f, stat_map[f]) for f in file_set]
+                    # the content checksum is only computed if the size and mtime checksum matches; it reuses the
+                    #   subdirectory listings of the first pass instead of stat'ing every file again
+                    listings = {} if conf.use_file_checksum else None
+                    keep = checksum_walk(walk_list, path, conf, False, walk_res, listings) == \
+                        remote_file[checksum_keys[0]] and (
+                            not conf.use_file_checksum or
+                            checksum_walk(walk_list, path, conf, True, listings=listings) ==
+                            remote_file['file_checksum'])
             if keep:
-                child_list.difference_update(file_list)
+                child_list -= file_set
                 remote_names.add(filename)
-                res.set_force_retain(path)
+                res.set_force_retain(path, state)
                 res.metadata['files'][filename] = remote_file
                 res.total_size += walk_res.total_size
                 res.total_files += walk_res.total_files
                 # Update for complete hardlink metadata
                 hardlinks: Dict[Tuple[int, int], bytes] = {}
                 for item_key, item_path in walk_res.hard_link_map.items():
-                    update_hardlink_map(item_key, item_path, hardlinks)
+                    update_hardlink_map(state, item_key, item_path, hardlinks)
                 state.hard_link_map.update(hardlinks)
             else:
                 # Note that because we base32-encoded directory names, they will never clash with tar names because of
                 #   the .tar extension
-                remote_del(filename, False)
+                remote_del(frame, state, filename, False, conf)
                 if conf.delete_after_upload:
                     remote_names.add(filename)
 
         # Delete remote directories
         for i in metadata['children']:
-            if decode_child(i) not in child_list or not stat.S_ISDIR(stat_map[decode_child(i)].st_mode):
-                remote_del(i, True)
+            child = decode_child(i)
+            if child not in child_list or stat_map[child].st_mode & S_IFMT_MASK != S_IFDIR:
+                remote_del(frame, state, i, True, conf)
 
-    # all children that needs to be uploaded
-    dir_result_map: Dict[bytes, UploadWalkResult] = {}
-    size_map: Dict[bytes, int] = {}
-    err_list: List[bytes] = []
+    frame.encoded_names = {child: encode_child(child) for child in child_list}
+    subdirs: List[bytes] = []
     for child in child_list:
         child_st = stat_map[child]
-        if stat.S_ISDIR(child_st.st_mode):
-            meta_child = metadata and metadata['children'].get(encode_child(child))
-            child_res = upload_walk(os.path.join(path, child), posixpath.join(remote_path, encode_child(child)),
-                                    child_st, meta_child, conf, state, False)
-            if child_res is not None:
-                dir_result_map[child] = child_res
-                if child_res.force_retain:
-                    res.set_force_retain(path)
-                    res.retained_directories += child_res.retained_directories
-                    res.metadata['children'][encode_child(child)] = child_res.metadata
-                    res.real_transfer_size += child_res.real_transfer_size
-                    res.real_transfer_files += child_res.real_transfer_files
-                else:
-                    size_map[child] = child_res.total_size + child_res.total_files * conf.file_base_bytes
-                res.total_size += child_res.total_size
-                res.total_files += child_res.total_files
-                res.total_transfer_size += child_res.total_transfer_size
-                res.total_transfer_files += child_res.total_transfer_files
-                res.total_deleted_files += child_res.total_deleted_files
-                res.files_to_delete += child_res.files_to_delete
-                res.error_count += child_res.error_count
-            else:
-                err_list.append(child)
+        if child_st.st_mode & S_IFMT_MASK == S_IFDIR:
+            subdirs.append(child)
         else:
-            size_map[child] = child_st.st_size + conf.file_base_bytes
+            frame.size_map[child] = child_st.st_size + conf.file_base_bytes
             res.total_size += child_st.st_size
             res.total_files += 1
             res.total_transfer_size += child_st.st_size
             res.total_transfer_files += 1
+    frame.subdirs = iter(subdirs)
+    return frame
+
+
+def add_child_result(frame: UploadFrame, child: bytes, child_res: UploadWalkResult, conf: UploadConfig,
+                     state: UploadState):
+    res = frame.res
+    frame.dir_result_map[child] = child_res
+    if child_res.force_retain:
+        res.set_force_retain(frame.path, state)
+        res.metadata['children'][frame.encoded_names[child]] = child_res.metadata
+        res.real_transfer_size += child_res.real_transfer_size
+        res.real_transfer_files += child_res.real_transfer_files
+    else:
+        frame.size_map[child] = child_res.total_size + child_res.total_files * conf.file_base_bytes
+    res.total_size += child_res.total_size
+    res.total_files += child_res.total_files
+    res.total_transfer_size += child_res.total_transfer_size
+    res.total_transfer_files += child_res.total_transfer_files
+    res.total_deleted_files += child_res.total_deleted_files
+    res.error_count += child_res.error_count
 
-    child_list.difference_update(err_list)
-
-    def multifile_checksum(names: List[bytes], second_pass: bool, hash_obj=None):
-        """
-        names already sorted
-        """
-        if hash_obj is None:
-            hash_obj = conf.hash_function()
-        for ch in names:
-            ch_st = stat_map[ch]
-            if stat.S_ISDIR(ch_st.st_mode):
-                ch_res = dir_result_map[ch]
-                if second_pass and conf.use_file_checksum:
-                    hash_obj.update(ch_res.second_checksum)
-                else:
-                    hash_obj.update(ch_res.first_checksum)
-            else:
-                hash_obj.update(one_file_checksum(ch, os.path.join(path, ch), ch_st, conf, second_pass))
-        return hash_obj
+
+def finish_upload_dir(frame: UploadFrame, conf: UploadConfig, state: UploadState) -> UploadWalkResult:
+    """
+    Group and upload the children of a directory whose subdirectories have all been visited
+    """
+    path, remote_path, res = frame.path, frame.remote_path, frame.res
+    stat_map, child_list, size_map = frame.stat_map, frame.child_list, frame.size_map
+    dir_result_map = frame.dir_result_map
+    child_list.difference_update(frame.err_list)
 
     # If it is not root, no children is tar'd and the directory size is not larger than the merge threshold,
     #   calculate hashes and recurse back, thus treating the directory as one file
-    if not is_root and not res.force_retain and \
+    if not frame.is_root and not res.force_retain and \
             res.total_size + res.total_files * conf.file_base_bytes <= conf.merge_threshold:
         res.files_to_tar.add(path)
         for i in size_map:
-            res.files_to_tar.add(os.path.join(path, i))
+            res.files_to_tar.add(join_path(path, i))
         for i in dir_result_map.values():
             res.files_to_tar.update(i.files_to_tar)
             res.hard_link_map.update(i.hard_link_map)
         # calculate hashes
-        first_hash = init_file_checksum(os.path.basename(path), st, conf)
+        first_hash = init_file_checksum(os.path.basename(path), frame.st, conf)
+        sorted_children = sorted(child_list)
         if conf.use_file_checksum:
             second_hash = first_hash.copy()
-            res.second_checksum = multifile_checksum(sorted(child_list), True, second_hash).digest()
-        res.first_checksum = multifile_checksum(sorted(child_list), False, first_hash).digest()
-        # update hardlink map
-        for child in child_list:
+            multifile_checksum(frame, sorted_children, conf, first_hash, second_hash)
+            res.second_checksum = second_hash.digest()
+        else:
+            multifile_checksum(frame, sorted_children, conf, first_hash)
+        res.first_checksum = first_hash.digest()
+        # update hardlink map; in name order, so the path recorded for an inode linked twice here is deterministic
+        for child in sorted_children:
             child_st = stat_map[child]
-            if not stat.S_ISDIR(child_st.st_mode):
+            if child_st.st_mode & S_IFMT_MASK != S_IFDIR:
                 if child_st.st_nlink > 1:
-                    res.hard_link_map[(child_st.st_dev, child_st.st_ino)] = os.path.join(path, child)
+                    res.hard_link_map[(child_st.st_dev, child_st.st_ino)] = join_path(path, child)
         return res
 
-    res.set_force_retain(path)
-    if conf.grouping_order == 'size':
-        group_list = sorted(size_map, key=lambda x: (size_map[x], x))
-    elif conf.grouping_order == 'mtime':
-        group_list = sorted(size_map, key=lambda x: (stat_map[x].st_mtime_ns, x))
-    elif conf.grouping_order == 'ctime':
-        group_list = sorted(size_map, key=lambda x: (stat_map[x].st_ctime_ns, x))
-    elif conf.grouping_order == 'name':
-        group_list = sorted(size_map)
+    res.set_force_retain(path, state)
+    # (sort key, name, size); names are unique, so sizes are never compared
+    grouping_order = conf.grouping_order
+    if grouping_order == 'size':
+        group_list = [(size, child, size) for child, size in size_map.items()]
+    elif grouping_order == 'mtime':
+        group_list = [(stat_map[child].st_mtime_ns, child, size) for child, size in size_map.items()]
+    elif grouping_order == 'ctime':
+        group_list = [(stat_map[child].st_ctime_ns, child, size) for child, size in size_map.items()]
+    elif grouping_order == 'name':
+        group_list = [(child, child, size) for child, size in size_map.items()]
     else:
         raise NotImplementedError
+    group_list.sort()
 
     group_size = 0
     file_idx = 0
+    # length of path and the separator after it, which are stripped from files_to_tar
+    prefix_len = len(join_path(path, b''))
     current_group: List[bytes] = []
-    for i, child in enumerate(group_list):
-        group_size += size_map[child]
+    last_idx = len(group_list) - 1
+    for i, (_, child, size) in enumerate(group_list):
+        group_size += size
         current_group.append(child)
-        if group_size > conf.merge_threshold or i == len(group_list) - 1:
-            current_group.sort()
+        if group_size > conf.merge_threshold or i == last_idx:
+            if grouping_order != 'name':
+                # already in name order otherwise
+                current_group.sort()
             # Find an available filename
             while True:
                 upload_name = f'{conf.reserved_prefix}{file_idx:05d}.tar{conf.compression_suffix}'
-                if upload_name not in remote_names:
+                if upload_name not in frame.remote_names:
                     break
                 file_idx += 1
             # Update metadata
-            meta_item = {'list': [encode_child(f) for f in current_group]}
+            meta_item = {'list': [frame.encoded_names[f] for f in current_group]}
+            first_hash = conf.new_hash()
             if conf.use_file_checksum:
-                meta_item['file_size_checksum'] = multifile_checksum(current_group, False).hexdigest()
-                meta_item['file_checksum'] = multifile_checksum(current_group, True).hexdigest()
+                second_hash = conf.new_hash()
+                multifile_checksum(frame, current_group, conf, first_hash, second_hash)
+                meta_item['file_size_checksum'] = first_hash.hexdigest()
+                meta_item['file_checksum'] = second_hash.hexdigest()
             else:
-                meta_item['mtime_checksum'] = multifile_checksum(current_group, False).hexdigest()
+                multifile_checksum(frame, current_group, conf, first_hash)
+                meta_item['mtime_checksum'] = first_hash.hexdigest()
             res.metadata['files'][upload_name] = meta_item
 
-            # Get list of all files need to be tar'd and update hardlink map
+            # Get list of all files need to be tar'd, relative to current path, and update hardlink map
             upload_list: List[bytes] = []
             hardlinks: Dict[Tuple[int, int], bytes] = {}
             for f in current_group:
                 f_st = stat_map[f]
-                if stat.S_ISDIR(f_st.st_mode):
+                if f_st.st_mode & S_IFMT_MASK == S_IFDIR:
                     f_res = dir_result_map[f]
-                    upload_list += list(f_res.files_to_tar)
+                    # files_to_tar holds full paths under path
+                    upload_list.extend([i[prefix_len:] for i in f_res.files_to_tar])
                     for item_key, item_path in f_res.hard_link_map.items():
-                        update_hardlink_map(item_key, item_path, hardlinks)
+                        update_hardlink_map(state, item_key, item_path, hardlinks)
                 else:
-                    f_path = os.path.join(path, f)
-                    upload_list.append(f_path)
+                    upload_list.append(f)
                     if f_st.st_nlink > 1:
-                        update_hardlink_map((f_st.st_dev, f_st.st_ino), f_path, hardlinks)
+                        update_hardlink_map(state, (f_st.st_dev, f_st.st_ino), join_path(path, f), hardlinks)
             state.hard_link_map.update(hardlinks)
 
-            # Make paths relative to current path
-            for idx in range(len(upload_list)):
-                assert path == upload_list[idx][:len(path)], f'{path} {upload_list[idx]}'
-                upload_list[idx] = os.path.relpath(upload_list[idx], path)
             upload_list.sort()
 
-            remote_name = posixpath.join(remote_path, upload_name)
+            remote_name = join_remote(remote_path, upload_name)
             logging.info(f'Upload {current_group} in {repr(path)[1:]} to {remote_name}')
             # If the file state changed from A to B between the checksum computation and the time of upload,
             #   and later rollbacked to A, the remote will stay at state B and remain undetected by further syncs.
             # Since we detect mtime changes, this edge case is less likely to happen without intentional action.
-            if not remote_upload(upload_list, remote_name, group_size):
-                # A extreme edge case may make upload fail: when conf.file_base_bytes is an underestimation so that
-                #   the real upload size is larger than ~50GiB (the S3 limit with the default chunk size) but
-                #   group_size is not, the upload function may fail to use the proper chunk size.
-                # This case needs an infeasibly large number of small files so we do not deal with this yet
-                log_name = repr(os.path.join(path, upload_name.encode()))[1:]
-                logging.warning(f'Failed to upload: {log_name}')
-                # delete from metadata so later syncs can detect it
-                del res.metadata['files'][upload_name]
-                res.error_count += 1
+            submit_upload(frame, state, upload_list, upload_name, remote_name, group_size, conf)
 
             current_group = []
             group_size = 0
@@ -333,51 +473,217 @@ def upload_walk(path: bytes, remote_path: str, st: os.stat_result, metadata: Opt
     return res
 
 
+def upload_walk(path: bytes, remote_path: str, st: os.stat_result, metadata: Optional[dict], conf: UploadConfig,
+                state: UploadState, is_root: bool) -> Optional[UploadWalkResult]:
+    """
+    Metadata format:
+    {
+      "files": { // each represents a remote file
+        "xxx.tar.gz": { // filename, contains only [A-Za-z0-9_.]
+          "list": [b32encode of first-layer dir/files],
+          "file_size_checksum": "...", <if conf.use_file_checksum>
+          "file_checksum": "...", <if conf.use_file_checksum>
+          "mtime_checksum": "...", <if not conf.use_file_checksum>
+        }
+      },
+      "children": {
+        <b32encode of name>: (another metadata), ...
+      },
+    }
+
+    Note that we upload each inode once in every tar file it is in, so hard links across different tar files will be
+      uploaded multiple times.
+    It is possible to only upload once for each inode globally, but it requires extra metadata information and passes to
+      check and correctly update changes of the hardlink structure, so currently we do not implement it.
+
+    Directories are visited in post-order with an explicit stack instead of recursion, so deep trees do not hit the
+      recursion limit; see open_upload_dir and finish_upload_dir
+    """
+    frame = open_upload_dir(path, remote_path, st, metadata, conf, state, is_root)
+    if frame is None:
+        return None
+    stack: List[UploadFrame] = [frame]
+    while True:
+        frame = stack[-1]
+        child = next(frame.subdirs, None)
+        if child is not None:
+            encoded = frame.encoded_names[child]
+            meta_child = frame.metadata and frame.metadata['children'].get(encoded)
+            child_frame = open_upload_dir(join_path(frame.path, child), join_remote(frame.remote_path, encoded),
+                                          frame.stat_map[child], meta_child, conf, state, False)
+            if child_frame is None:
+                frame.err_list.append(child)
+            else:
+                stack.append(child_frame)
+            continue
+        stack.pop()
+        res = finish_upload_dir(frame, conf, state)
+        if not stack:
+            res.files_to_delete = state.files_to_delete
+            res.retained_directories = state.retained_directories
+            return res
+        add_child_result(stack[-1], os.path.basename(frame.path), res, conf, state)
+
+
+def hard_link_groups(pairs: List[Tuple[bytes, bytes]]) -> List[List[bytes]]:
+    """
+    Group the paths connected by pairs, in order of first appearance
+    Union-find over paths numbered in order of appearance: a flat parent list, with path halving in find and the root
+      always being the smallest number
+    """
+    ids: Dict[bytes, int] = {}
+    parent: List[int] = []
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for pair in pairs:
+        roots = []
+        for path in pair:
+            idx = ids.get(path)
+            if idx is None:
+                idx = ids[path] = len(parent)
+                parent.append(idx)
+            roots.append(find(idx))
+        x, y = roots
+        if x != y:
+            parent[max(x, y)] = min(x, y)
+    groups: Dict[int, List[bytes]] = {}
+    for path, idx in ids.items():
+        groups.setdefault(find(idx), []).append(path)
+    return list(groups.values())
+
+
+def delete_remote_file(file: str, is_dir: bool, conf: UploadConfig) -> bool:
+    logging.info(f'Deleting remote: {file}')
+    if not rclone_delete(file, is_dir, conf):
+        logging.warning(f'Failed to delete remote: {file}')
+        return False
+    return True
+
+
+def delete_remote_batch(path: str, files: List[Tuple[str, str]], conf: UploadConfig) -> int:
+    """
+    Delete files (list of (name, full remote path)) in the remote directory path with one rclone
+    Returns the number of successful deletions
+    """
+    for _, file in files:
+        logging.info(f'Deleting remote: {file}')
+    if not rclone_delete_files(path, [name for name, _ in files], conf):
+        logging.warning(f'Failed to delete remote files in {path}: {[name for name, _ in files]}')
+        return 0
+    return len(files)
+
+
+def delete_remote_files(files: List[Tuple[str, bool]], conf: UploadConfig) -> int:
+    """
+    Delete remote files and directories, with up to conf.transfer_threads deletions running at a time
+    Files in the same remote directory are deleted by a single rclone, unless conf.use_rclone_rcd already saves
+      starting a process per file
+    The files never overlap (a purged directory is not walked), so the order does not matter
+    Returns the number of successful deletions
+    """
+    tasks: List[Callable[[], int]] = []
+    batches: Dict[str, List[Tuple[str, str]]] = {}
+    for file, is_dir in files:
+        if is_dir or conf.use_rclone_rcd:
+            tasks.append(functools.partial(delete_remote_file, file, is_dir, conf))
+        else:
+            parent, name = split_remote(file)
+            batches.setdefault(parent, []).append((name, file))
+    for parent, batch in batches.items():
+        if len(batch) == 1:
+            tasks.append(functools.partial(delete_remote_file, batch[0][1], False, conf))
+        else:
+            tasks.append(functools.partial(delete_remote_batch, parent, batch, conf))
+    if len(tasks) <= 1 or conf.transfer_threads == 1:
+        return sum(task() for task in tasks)
+    with ThreadPoolExecutor(max_workers=min(conf.transfer_threads, len(tasks)), thread_name_prefix='delete') as pool:
+        return sum(pool.map(lambda task: task(), tasks))
+
+
 def upload_meta(path: bytes, remote_path: str, metadata: Optional[dict],
                 conf: UploadConfig) -> Optional[UploadWalkResult]:
     st = os.stat(path)
     state = UploadState()
-    # TODO: use a thread pool for uploading
-    res = upload_walk(path, remote_path, st, metadata and metadata['meta'], conf, state, True)
+    with ExitStack() as stack:
+        if conf.stat_threads > 1:
+            state.stat_pool = stack.enter_context(
+                ThreadPoolExecutor(max_workers=conf.stat_threads, thread_name_prefix='stat'))
+        if conf.transfer_threads > 1:
+            # tarballs are uploaded while the walk goes on; they are all done before anything is deleted below
+            state.upload_pool = stack.enter_context(
+                ThreadPoolExecutor(max_workers=conf.transfer_threads, thread_name_prefix='upload'))
+        res = upload_walk(path, remote_path, st, metadata and metadata['meta'], conf, state, True)
+        # the results of all directories end up in the root result, so the uploads are accounted there
+        for upload_path, upload_name, files_meta, future in state.uploads:
+            collect_upload(res, upload_path, upload_name, files_meta, future.result())
     if not res:
         return None
-    for file, is_dir in res.files_to_delete:
-        logging.info(f'Deleting remote: {file}')
-        if not rclone_delete(file, is_dir, conf):
-            logging.warning(f'Failed to delete remote: {file}')
-            res.error_count += 1
-        else:
-            res.total_deleted_files += 1
+    deleted = delete_remote_files(res.files_to_delete, conf)
+    res.total_deleted_files += deleted
+    res.error_count += len(res.files_to_delete) - deleted
     root_name = f'{conf.reserved_prefix}ROOT.tar{conf.compression_suffix}'
-    dir_to_tar = [os.path.relpath(i, path) for i in sorted(res.retained_directories)]
+    # all paths of the walk are built by join_path from path, so they are made relative by stripping this prefix
+    #   instead of os.path.relpath, which normalizes both paths every time; path itself becomes '.'
+    prefix_len = len(join_path(path, b''))
+    dir_to_tar = [i[prefix_len:] or b'.' for i in sorted(res.retained_directories)]
     # always update retained directories
-    nbytes = rclone_upload(path, dir_to_tar, posixpath.join(remote_path, root_name), conf,
+    nbytes = rclone_upload(path, dir_to_tar, join_remote(remote_path, root_name), conf,
                            len(dir_to_tar) * 4096)
     if nbytes >= 0:
         res.real_transfer_size += nbytes
         res.real_transfer_files += 1
-    hard_link_djs = DisjointSet()
-    for x, y in state.hard_link_list:
-        hard_link_djs.union(x, y)
     res.metadata = {'version': conf.metadata_version,
                     'meta': res.metadata,
                     'root_name': root_name,
+                    # reused by compression 'auto'; see recorded_compression
+                    'compression': conf.compression or 'none',
                     'checksum': {
                         'use_file_checksum': conf.use_file_checksum,
                         'use_directory_mtime': conf.use_directory_mtime,
                         'use_owner': conf.use_owner,
-                        'hash_function': conf.hash_function().name,
+                        'hash_function': conf.hash_name,
                     },
-                    'hard_links': [{'group': [encode_child(os.path.relpath(j, path)) for j in i]}
-                                   for i in hard_link_djs.itersets()]}
+                    'hard_links': [{'group': [encode_child(j[prefix_len:]) for j in i]}
+                                   for i in hard_link_groups(state.hard_link_list)]}
     return res
 
 
+def recorded_compression(metadata: dict) -> Optional[Tuple[str, str]]:
+    """
+    (compression program or 'none', tarball suffix) of an existing upload, for UploadConfig.resolve_auto_compression
+    Metadata written before the program was recorded falls back to the program matching the suffix, if known
+    """
+    suffix = tarball_suffix(metadata['root_name'])
+    program = metadata.get('compression')
+    if program is None:
+        if suffix not in SUFFIX_COMPRESSIONS:
+            return None
+        program = SUFFIX_COMPRESSIONS[suffix] or 'none'
+    return program, suffix
+
+
 def upload(path: bytes, remote_path: str, conf: UploadConfig) -> Optional[UploadWalkResult]:
     # TODO: Display a warning if remote_path does not support instant retrieval and conf.metadata_path is None
     metadata = load_metadata(remote_path, conf)
     if metadata is None:
         logging.warning('Metadata reading failed. It is normal if this is the first upload.')
+    conf.resolve_auto_hash_function(metadata and metadata['checksum']['hash_function'])
+    conf.resolve_auto_compression(metadata and recorded_compression(metadata))
+    if conf.use_file_checksum:
+        if conf.checksum_cache_path is not None:
+            conf.checksum_cache = load_checksum_cache(conf.checksum_cache_path, conf.hash_name)
+        else:
+            # still reuse content checksums within this run; a file in a group that changed is hashed once when
+            #   checking the old group and again when checksumming the new one
+            conf.checksum_cache = ChecksumCache(conf.hash_name)
     res = upload_meta(path, remote_path, metadata, conf)
+    clear_child_caches()
     save_metadata(res.metadata, remote_path, conf)
+    if conf.checksum_cache_path is not None and conf.checksum_cache is not None:
+        save_checksum_cache(conf.checksum_cache, conf.checksum_cache_path)
     return res
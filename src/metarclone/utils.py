@@ -1,9 +1,15 @@
+import functools
 import logging
+import os
 import shutil
+import threading
 from base64 import b32decode, b32encode
 from contextlib import contextmanager
 
-__all__ = ['wrap_oserror', 'decode_child', 'encode_child', 'win_to_posix', 'is_path', 'cmd_to_abs_path']
+__all__ = ['wrap_oserror', 'decode_child', 'encode_child', 'clear_child_caches', 'win_to_posix', 'is_path',
+           'cmd_to_abs_path', 'thread_buffer', 'join_path', 'join_remote']
+
+_local = threading.local()
 
 
 @contextmanager
@@ -14,15 +20,24 @@ def wrap_oserror(path: bytes):
         logging.warning(f'Error accessing {repr(path)[1:]}: {e}')
 
 
+# Names repeat a lot across a tree (e.g. src, include, __init__.py), and b32decode / b32encode are written in Python
+#   The caches are cleared after each upload / download; see clear_child_caches
+@functools.lru_cache(maxsize=131072)
 def decode_child(name: str):
     pad_length = len(name) % 8
     return b32decode(name + '=' * (pad_length and 8 - pad_length))
 
 
+@functools.lru_cache(maxsize=131072)
 def encode_child(name: bytes):
     return b32encode(name).decode().rstrip('=')
 
 
+def clear_child_caches():
+    decode_child.cache_clear()
+    encode_child.cache_clear()
+
+
 def win_to_posix(path: bytes):
     return path.replace(b'\\', b'/')
 
@@ -38,3 +53,36 @@ def cmd_to_abs_path(cmd: str):
     if not res:
         raise FileNotFoundError(f'Cannot find executable: {cmd}')
     return res
+
+
+def thread_buffer(size: int, slot: int = 0) -> memoryview:
+    """
+    A reusable buffer of the given size owned by the current thread
+    Different slots give different buffers, for callers that need several at once
+    Callers must not hold it across calls that may use the same buffer
+    """
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    key = (size, slot)
+    buffer = buffers.get(key)
+    if buffer is None:
+        buffer = buffers[key] = memoryview(bytearray(size))
+    return buffer
+
+
+if os.name == 'nt':
+    join_path = os.path.join
+else:
+    def join_path(path: bytes, name: bytes) -> bytes:
+        """
+        os.path.join for a directory and a single name from os.listdir / os.scandir, without the generic overhead
+        """
+        return path + b'/' + name if path and not path.endswith(b'/') else path + name
+
+
+def join_remote(path: str, name: str) -> str:
+    """
+    posixpath.join for a remote directory and a single name, without the generic overhead
+    """
+    return path + '/' + name if path and not path.endswith('/') else path + name
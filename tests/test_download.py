@@ -0,0 +1,41 @@
+import importlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from metarclone import DownloadConfig
+from metarclone.config import hash_constructor
+
+# the package binds metarclone.download to the function, so fetch the module itself
+download_module = importlib.import_module('metarclone.download')
+
+
+def make_metadata(hash_function: str) -> dict:
+    return {
+        'checksum': {'use_file_checksum': True, 'use_directory_mtime': False, 'use_owner': False,
+                     'hash_function': hash_function},
+        'root_name': '_METARCLONE_ROOT.tar.gz',
+        'meta': {'files': {}, 'children': {}},
+        'hard_links': [],
+    }
+
+
+class MissingHashBackendTest(unittest.TestCase):
+    def test_download_without_hash_backend(self):
+        # a None entry in sys.modules makes `import blake3` raise ImportError
+        with mock.patch.dict(sys.modules, {'blake3': None}), \
+                mock.patch.object(download_module, 'rclone_download', return_value=0) as rclone_download, \
+                tempfile.TemporaryDirectory() as path:
+            with self.assertRaises(NameError):
+                hash_constructor('blake3')
+            conf = DownloadConfig()
+            conf.dest_as_empty = True
+            res = download_module.download_meta(path.encode(), 'remote:dest', make_metadata('blake3'), conf)
+        self.assertEqual(conf.hash_name, 'blake3')
+        self.assertEqual(res.error_count, 0)
+        rclone_download.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()